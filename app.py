@@ -1,22 +1,73 @@
+import csv
+import hmac
+import json
 import os
-import threading
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from wsgiref.simple_server import WSGIServer
 
+import requests
 from bottle import route, run, request, response
 
 import google
+import jobs
+import metrics
+import snapshots
 import wrike
 
 my_env = os.getenv('my_env')
 
+timelog_workbook_url = 'https://docs.google.com/spreadsheets/d/1tkjX3EL8LhftztrM0FR2gRJH6foC6zCFCHY4fdrKjVY/edit#gid=0'
+project_status_workbook_url = os.environ.get('project_status_workbook_url', timelog_workbook_url)
+
+session_max_age = 30 * 24 * 3600  # of the wrike_session cookie
+snapshot_ttl = int(os.environ.get('snapshot_ttl', 900))  # seconds before a report view starts rebuilding its snapshot
+
+scheduler = jobs.JobScheduler(workers=int(os.environ.get('report_workers', 2)))
+report_snapshots = snapshots.SnapshotStore(os.path.join(wrike.cache_dir, 'snapshots'))
+
+
+def session_creds():
+    """
+    The Wrike credentials of the browser session, by its wrike_session cookie. A session the store does not know
+    (first visit, or the app restarted) starts from the wrike_refresh_token cookie if there is one.
+    :return: (session id, NewCreds)
+    """
+    session_id = request.get_cookie('wrike_session')
+    user_creds = wrike.credential_store.get(session_id)
+    if user_creds is None:
+        session_id, user_creds = wrike.credential_store.create()
+        user_creds.refresh_token = request.get_cookie('wrike_refresh_token') or ''
+    return session_id, user_creds
+
+
+def ensure_fresh(user_creds):
+    """ user_creds.ensure_fresh(), where Wrike failing to refresh the token also means authorizing again, not a 500 """
+    try:
+        return user_creds.ensure_fresh()
+    except (wrike.WrikeError, requests.RequestException) as e:
+        print 'token refresh failed:', repr(e)
+        return False
+
+
+def set_session_cookies(session_id, user_creds):
+    response.set_cookie('wrike_session', session_id, max_age=session_max_age, httponly=True)
+    response.set_cookie("wrike_refresh_token", user_creds.refresh_token, max_age=3600)  # make expire date a dynamic duration TODO
+
 
 @route('/')
 def landing_page():
     if unicode(request.query.get('code', ''), "utf-8") != '':
-        import wrike
-        if not wrike.creds.new_auth(unicode(request.query.get('code', ''), "utf-8")):
+        session_id, user_creds = wrike.credential_store.create()
+        try:
+            authorized = user_creds.new_auth(unicode(request.query.get('code', ''), "utf-8"))
+        except (wrike.WrikeError, requests.RequestException) as e:
+            print 'authorization failed:', repr(e)
+            authorized = False
+        if not authorized:
             return 'Fatal Error'
         else:
-            response.set_cookie("wrike_refresh_token", wrike.creds.refresh_token, max_age=3600)  # make expire date a dynamic duration TODO
+            set_session_cookies(session_id, user_creds)
 
     timelog_page = "/wrike/timelogs/"
     project_status_page = "/wrike/projectstatus/"
@@ -25,45 +76,41 @@ def landing_page():
            '<a href="' + timelog_page + '">Run timelog report.</a> <br>' + \
            '<a href="' + project_status_page + '">Run project status report.</a> <br>' + \
            '<a href="' + track_assessment_page + '">Run track assessment report.</a> <br>' + \
+           '<br> Latest data: <a href="/reports/timelogs.csv">timelogs</a>, <a href="/reports/projectstatus.csv">project status</a> <br>' + \
            ''
 
 
+def reauth_page():
+    return 'Please click <a href="https://www.wrike.com/oauth2/authorize?client_id=' + wrike.client_id + \
+           '&response_type=code' \
+           '&scope=wsReadOnly, wsReadWrite, amReadOnlyWorkflow, amReadWriteWorkflow, amReadOnlyInvitation, amReadWriteInvitation,' \
+           ' amReadOnlyGroup, amReadWriteGroup, amReadOnlyUser, amReadWriteUser">here to reauth.</a>'
+
+
 @route('/wrike/<path>/')
 def wrike_page(path=''):
     # try:
 
-    if request.get_cookie("wrike_refresh_token"):
-        print 'cookie found'
-        my_cookie = request.get_cookie("wrike_refresh_token")
-        wrike.creds.refresh_token = my_cookie
+    session_id, user_creds = session_creds()
+    if not ensure_fresh(user_creds):  # no call to Wrike while the access token is good
+        return reauth_page()
     else:
-        print 'no cookie found'
-
-    if not wrike.creds.refresh():
-        return 'Please click <a href="https://www.wrike.com/oauth2/authorize?client_id=' + wrike.client_id + \
-               '&response_type=code' \
-               '&scope=wsReadOnly, wsReadWrite, amReadOnlyWorkflow, amReadWriteWorkflow, amReadOnlyInvitation, amReadWriteInvitation,' \
-               ' amReadOnlyGroup, amReadWriteGroup, amReadOnlyUser, amReadWriteUser">here to reauth.</a>'
-    else:
-        response.set_cookie("wrike_refresh_token", wrike.creds.refresh_token, max_age=3600)  # make expire date a dynamic duration TODO
+        set_session_cookies(session_id, user_creds)
 
     if path == 'timelogs':
-        timelog_list = wrike.get_timelog_table()
-        sheets = google.NewSession()
-        workbook_url = 'https://docs.google.com/spreadsheets/d/1tkjX3EL8LhftztrM0FR2gRJH6foC6zCFCHY4fdrKjVY/edit#gid=0'
-        sheets.open_workbook(workbook_url)
-        sheets.open_worksheet('Sheet2')
-        sheets.clear_sheet()
-        sheets.upload_table(timelog_list, start_row=2)
-        return 'Your sheet was updated at <a href="{}">{}</a>'.format(workbook_url, workbook_url)
+        full = bool(request.query.get('full'))  # ?full=1 rebuilds the whole sheet instead of syncing the changes
+        job = scheduler.submit('timelogs-full' if full else 'timelogs', wrike.using(user_creds, run_timelog_report), full)
+        return 'Your sheet is being updated at <a href="{0}">{0}</a>, ' \
+               '<a href="/jobs/{1}">check the progress here</a>.'.format(timelog_workbook_url, job.id)
 
     if path == 'projectstatus':
-        wrike.get_project_details()
+        job = scheduler.submit('projectstatus', wrike.using(user_creds, run_project_status_report))
+        return 'The project status is being updated at <a href="{0}">{0}</a>, ' \
+               '<a href="/jobs/{1}">check the progress here</a>.'.format(project_status_workbook_url, job.id)
 
     if path == 'assessment_time':
-        t = threading.Thread(name='tracker', target=wrike.track_wrike)
-        t.start()
-        # print t.isAlive()
+        job = scheduler.singleton('tracker', wrike.using(user_creds, wrike.track_wrike))
+        return 'The assessment tracker is running, <a href="/jobs/{}">check it here</a>.'.format(job.id)
 
     # except Exception as e:
     #     exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -83,12 +130,176 @@ def wrike_page(path=''):
     return '<pre>Command ', path, ' unknown</pre>'
 
 
+def run_timelog_report(full=False):
+    if full:
+        wrike.timelog_sync.reset()
+        wrike.metadata_cache.invalidate()
+    sheets = google.NewSession()
+    sheets.open_workbook(timelog_workbook_url)
+    sheets.open_worksheet('Sheet2')
+    return {'rows_written': wrike.timelog_sync.sync(sheets, start_row=2), 'url': timelog_workbook_url}
+
+
+def run_project_status_report():
+    table = wrike.get_project_details()
+    report_snapshots.save('projectstatus', table)
+    sheets = google.NewSession()
+    sheets.open_workbook(project_status_workbook_url)
+    sheets.open_worksheet('Project Status', force=True)
+    sheets.upload_table(table)  # one batched write, then drop the rows a longer report left behind
+    sheets.trim_rows(len(table))
+    return {'rows': len(table) - 1, 'url': project_status_workbook_url}
+
+
+export_chunk_size = int(os.environ.get('export_chunk_size', 500))  # small chunks, so the first rows go out quickly
+
+
+def _csv_lines(rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+    return buf.getvalue()
+
+
+def _ndjson_lines(rows):
+    return ''.join(json.dumps(dict(zip(wrike.timelog_columns, row))) + '\n' for row in rows)
+
+
+@route('/wrike/timelogs.<export_format:re:csv|ndjson>')
+def timelog_export(export_format):
+    """
+    Stream the enriched timelogs as CSV or newline delimited JSON, one chunk of rows at a time as they are built,
+    so nothing but the current chunk is held. The CSV header goes out before Wrike is even called; NDJSON has no header,
+    so its first bytes wait for Wrike's timelog response (it is not paginated) and the first chunk. The sub second
+    first byte only holds for CSV.
+    """
+    session_id, user_creds = session_creds()
+    if not ensure_fresh(user_creds):
+        response.status = 401
+        return reauth_page()
+    set_session_cookies(session_id, user_creds)
+
+    if export_format == 'csv':
+        response.content_type = 'text/csv; charset=utf-8'
+        lines, header = _csv_lines, _csv_lines([wrike.timelog_columns])
+    else:
+        response.content_type = 'application/x-ndjson'
+        lines, header = _ndjson_lines, None
+    response.set_header('Content-Disposition', 'attachment; filename=timelogs.' + export_format)
+
+    def stream():
+        if header:
+            yield header
+        for timelogs, rows in wrike.iter_using(user_creds, wrike.iter_timelog_chunks(chunk_size=export_chunk_size)):
+            yield lines(rows)
+
+    return stream()
+
+
+report_builders = {'timelogs': lambda: [wrike.timelog_columns] + wrike.get_timelog_table(),  # header first, like the project status
+                   'projectstatus': wrike.get_project_details}
+
+
+def refresh_snapshot(name):
+    snapshot = report_snapshots.save(name, report_builders[name]())
+    return {'version': snapshot.version, 'rows': len(snapshot.rows) - 1}
+
+
+@route('/reports/<name:re:timelogs|projectstatus>.<export_format:re:json|csv>')
+def report_view(name, export_format):
+    """
+    Serve the latest snapshot of a report straight away, with its age. When it is older than snapshot_ttl a background
+    job builds the next one; the job is keyed by report, so however many views come in only one rebuild runs at a time.
+    """
+    session_id, user_creds = session_creds()
+    if not ensure_fresh(user_creds):
+        response.status = 401
+        return reauth_page()
+    set_session_cookies(session_id, user_creds)
+
+    snapshot = report_snapshots.latest(name)
+    job = None
+    if snapshot is None or snapshot.age() > snapshot_ttl:
+        job = scheduler.submit('snapshot-' + name, wrike.using(user_creds, refresh_snapshot), name)
+    if snapshot is None:
+        response.status = 202
+        return {'status': 'building the first snapshot', 'job': '/jobs/' + job.id}
+
+    response.set_header('X-Snapshot-Version', str(snapshot.version))
+    response.set_header('X-Snapshot-Age', str(int(snapshot.age())))
+    if export_format == 'json':
+        return {'name': name,
+                'version': snapshot.version,
+                'created': snapshot.created,
+                'age': int(snapshot.age()),
+                'refreshing': '/jobs/' + job.id if job else None,
+                'columns': snapshot.rows[0],
+                'rows': snapshot.rows[1:]}
+
+    response.content_type = 'text/csv; charset=utf-8'
+    response.set_header('Content-Disposition', 'attachment; filename={}.csv'.format(name))
+    rows = snapshot.rows
+    return (_csv_lines(rows[i:i + export_chunk_size]) for i in range(0, len(rows), export_chunk_size))
+
+
+@route('/wrike/webhook', method='POST')
+def wrike_webhook():
+    """
+    receives the inbound folder's task events and queues the task ids for the tracker. Only signed posts are taken,
+    without wrike_webhook_secret there is no way to tell Wrike from anyone else, so every post is refused.
+    """
+    if not wrike.webhook_secret:
+        response.status = 403
+        return 'webhooks are disabled, wrike_webhook_secret is not set'
+    body = request.body.read()
+    if request.get_header('X-Hook-Secret'):  # handshake when the webhook is created
+        if not wrike.webhook_handshake.is_set():  # any other time it would sign whatever it was sent
+            response.status = 403
+            return 'no webhook is being created'
+        response.set_header('X-Hook-Secret', wrike.webhook_signature(request.get_header('X-Hook-Secret')))
+        return ''
+    if not hmac.compare_digest(str(request.get_header('X-Hook-Signature', '')), wrike.webhook_signature(body)):
+        response.status = 401
+        return 'bad signature'
+    try:
+        task_ids = wrike.webhook_task_ids(json.loads(body))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        response.status = 400
+        return 'bad payload'
+    wrike.assessment_events.put(task_ids)
+    # no-op when it is already running, otherwise it runs as the last user who used the app
+    scheduler.singleton('tracker', wrike.using(wrike.credential_store.latest() or wrike.creds, wrike.track_wrike))
+    return ''
+
+
+@route('/jobs/<job_id>')
+def job_page(job_id):
+    job = scheduler.get(job_id)
+    if not job:
+        response.status = 404
+        return {'error': 'unknown job ' + job_id}
+    return job.to_dict()
+
+
+@route('/metrics')
+def metrics_page():
+    """ Wrike, rate limiter, Sheets and report phase metrics for Prometheus to scrape """
+    response.content_type = metrics.content_type
+    return metrics.render()
+
+
 # IEAAYQ33KQC4HFGQ
 
 
 
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """ a thread per request, so a long export does not hold up every other page """
+    daemon_threads = True
+
+
 # if __name__ == "__main__":
 if my_env == 'local':
-    run(host='localhost', port=int(os.environ.get('PORT', 8080)))
+    run(host='localhost', port=int(os.environ.get('PORT', 8080)), server_class=ThreadingWSGIServer)
 else:
-    run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+    run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), server_class=ThreadingWSGIServer)
@@ -0,0 +1,159 @@
+"""
+In-memory stand-ins for the parts of gspread that google.NewSession uses, counting every call and every cell written.
+Install with `google.pool = FakePool()`, every NewSession then works on the same in-memory workbooks.
+"""
+import re
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import gspread
+
+stats = defaultdict(int)  # {'calls.<method>': n, 'cells_read': n, 'cells_written': n}
+_lock = threading.Lock()
+
+
+def count(name, n=1):
+    with _lock:
+        stats[name] += n
+
+
+_date = re.compile(r'^(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)$')
+
+
+def entered(value):
+    """
+    (input value, numeric value) of a cell that value was written to. Like Sheets, numbers and dates are parsed,
+    so '1.50' reads back as '1.5' and '2016-03-01 19:00:00' as '3/1/2016 19:00:00' (the en_US locale).
+    """
+    try:
+        number = float(value)
+        if number == number and abs(number) != float('inf'):
+            return '%.15g' % number, number
+    except ValueError:
+        pass
+    match = _date.match(value)
+    if match:
+        date = datetime(*map(int, match.groups()))
+        serial = (date - datetime(1899, 12, 30)).total_seconds() / 86400
+        return '{}/{}/{} {}'.format(date.month, date.day, date.year, date.strftime('%H:%M:%S')), serial
+    return value, None
+
+
+class FakeCell(object):
+    def __init__(self, row, col, value=''):
+        self.row = row
+        self.col = col
+        self.input_value, self.numeric_value = entered(value)  # cells keep what was written, it is parsed when read
+        self.value = self.input_value
+
+
+class FakeWorksheet(object):
+    def __init__(self, title, rows=1, cols=1):
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.cells = {}  # {(row, col): value}
+
+    @staticmethod
+    def get_addr_int(row, col):
+        label = ''
+        while col:
+            col, remainder = divmod(col - 1, 26)
+            label = chr(65 + remainder) + label
+        return label + str(row)
+
+    @staticmethod
+    def get_int_addr(label):
+        match = re.match(r'([A-Z]+)(\d+)$', label)
+        col = 0
+        for char in match.group(1):
+            col = col * 26 + ord(char) - 64
+        return int(match.group(2)), col
+
+    def resize(self, rows=None, cols=None):
+        count('calls.resize')
+        if rows:
+            self.row_count = rows
+        if cols:
+            self.col_count = cols
+        self.cells = dict((key, value) for key, value in self.cells.items() if key[0] <= self.row_count and key[1] <= self.col_count)
+
+    def range(self, area):
+        count('calls.range')
+        (first_row, first_col), (last_row, last_col) = [self.get_int_addr(label) for label in area.split(':')]
+        count('cells_read', (last_row - first_row + 1) * (last_col - first_col + 1))
+        return [FakeCell(row, col, self.cells.get((row, col), ''))
+                for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+
+    def update_cells(self, cell_list):
+        count('calls.update_cells')
+        count('cells_written', len(cell_list))
+        for cell in cell_list:
+            self.cells[(cell.row, cell.col)] = cell.value if isinstance(cell.value, basestring) else unicode(cell.value)
+
+    def col_values(self, col):
+        count('calls.col_values')
+        values = [self.cells.get((row, col)) or None for row in range(1, self.row_count + 1)]
+        while values and values[-1] is None:
+            values.pop()
+        return values
+
+    def append_row(self, values):
+        count('calls.append_row')
+        count('cells_written', len(values))
+        self.row_count += 1
+        self.col_count = max(self.col_count, len(values))
+        for col, value in enumerate(values, 1):
+            self.cells[(self.row_count, col)] = value
+
+    def find(self, text):
+        count('calls.find')
+        for (row, col), value in sorted(self.cells.items()):
+            if value == text:
+                return FakeCell(row, col, value)
+        raise gspread.CellNotFound(text)
+
+
+class FakeWorkbook(object):
+    def __init__(self, url):
+        self.url = url
+        self.sheets = {}
+
+    def worksheet(self, title):
+        count('calls.worksheet')
+        if title not in self.sheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        count('calls.add_worksheet')
+        self.sheets[title] = FakeWorksheet(title, rows, cols)
+        return self.sheets[title]
+
+
+class FakePool(object):
+    """ same interface as google.ClientPool, every workbook url opens an in-memory workbook """
+
+    def __init__(self):
+        self.workbooks = {}
+
+    def get_client(self):
+        return self
+
+    def reset(self):
+        pass
+
+    def workbook(self, url):
+        if url not in self.workbooks:
+            count('calls.open_by_url')
+            self.workbooks[url] = FakeWorkbook(url)
+        return self.workbooks[url]
+
+    def worksheet(self, url, sheet_name, force=False):
+        """ the real workbooks already have their sheets, so missing ones are always created """
+        workbook = self.workbook(url)
+        try:
+            return workbook.worksheet(sheet_name)
+        except gspread.WorksheetNotFound:
+            return workbook.add_worksheet(sheet_name, 1, 1)
@@ -0,0 +1,202 @@
+"""
+A local stand-in for the parts of the Wrike v3 API this app calls, serving a synthetic account.
+Every request is counted per endpoint, with the bytes sent before and after gzip.
+"""
+import gzip
+import json
+import random
+import re
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from collections import defaultdict
+
+account_id = 'IEAAYQ33'
+inbound_folder_id = 'IEAAYQ33I4CVHLZI'
+opp_field_id = 'IEAAYQ33JUAACWWV'
+
+
+def wrike_date(day, second=0):
+    return '2016-%02d-%02dT%02d:%02d:%02dZ' % (day // 28 % 12 + 1, day % 28 + 1, second // 3600 % 24, second // 60 % 60, second % 60)
+
+
+class Account(object):
+    """
+    Synthetic account: `users` users, `projects` root tasks each with a chain of `depth` super tasks under it,
+    leaf tasks hanging off random chain levels, and `timelogs` timelogs spread over the leaves.
+    The inbound folder holds `requests` assessment requests, `assessed` of them already moved out.
+    """
+
+    def __init__(self, timelogs=1000, users=50, projects=20, depth=6, leaves=None, requests=40, assessed=5, seed=1):
+        rng = random.Random(seed)
+        self.users = dict(('KUAA%04d' % i, {'id': 'KUAA%04d' % i, 'firstName': 'User%d' % i, 'lastName': 'Bench'})
+                          for i in range(users))
+        self.folders = [{'id': 'IEAAYQ33I4F%05d' % i, 'title': 'Folder %d' % i, 'childIds': []} for i in range(10)]
+        self.tasks = {}
+        chain_nodes = []
+        for project in range(projects):
+            parent = None
+            for level in range(depth):
+                task = self._task('IEAAYQ33KQP%02d%03d' % (level, project), 'Project %d level %d' % (project, level), parent, rng)
+                if level == 0:
+                    task['customFields'] = [{'id': opp_field_id, 'value': 'OPP-%d' % project}]
+                chain_nodes.append(task['id'])
+                parent = task['id']
+        leaf_ids = []
+        for i in range(leaves or max(50, timelogs // 10)):
+            parent = rng.choice(chain_nodes) if rng.random() < 0.8 else None
+            leaf_ids.append(self._task('IEAAYQ33KQL%06d' % i, 'Task %d' % i, parent, rng)['id'])
+        for i in range(requests):
+            task = self._task('IEAAYQ33KQR%05d' % i, 'Assessment request %d' % i, None, rng)
+            task['parentIds'] = ['IEAAYQ33I4CVHOUT'] if i < assessed else [inbound_folder_id]
+        user_ids = sorted(self.users)
+        self.timelogs = []
+        for i in range(timelogs):
+            created = wrike_date(i % 300, i * 7 % 86400)
+            self.timelogs.append({'id': 'IEAAYQ33JQ%06d' % i,
+                                  'taskId': rng.choice(leaf_ids),
+                                  'userId': rng.choice(user_ids),
+                                  'hours': round(rng.random() * 8, 2),
+                                  'createdDate': created,
+                                  'updatedDate': created,
+                                  'trackedDate': created[:10],
+                                  'comment': 'worked on it %d' % i})
+        self.lock = threading.Lock()
+
+    def _task(self, task_id, title, super_task_id, rng):
+        task = {'id': task_id,
+                'accountId': account_id,
+                'title': title,
+                'parentIds': [rng.choice(self.folders)['id']],
+                'superTaskIds': [super_task_id] if super_task_id else [],
+                'customFields': [],
+                'status': rng.choice(['Active', 'Active', 'Completed', 'Deferred']),
+                'dates': {'type': 'Planned', 'start': wrike_date(rng.randrange(300))[:19], 'due': wrike_date(rng.randrange(300))[:19]},
+                'createdDate': wrike_date(rng.randrange(300)),
+                'updatedDate': wrike_date(rng.randrange(300)),
+                'permalink': 'https://www.wrike.com/open.htm?id=' + task_id[-6:]}
+        self.tasks[task_id] = task
+        return task
+
+    def touch_timelogs(self, fraction, new=0):
+        """ mark a fraction of the timelogs as updated and add `new` ones, like a day of work between two syncs """
+        with self.lock:
+            latest = max(log['updatedDate'] for log in self.timelogs)
+            stamp = latest[:4] + '-12-31T23:59:59Z'
+            for log in self.timelogs[::max(1, int(1 / fraction))] if fraction else []:
+                log['hours'] = round(log['hours'] + 0.25, 2)
+                log['updatedDate'] = stamp
+            for i in range(new):
+                log = dict(self.timelogs[i % len(self.timelogs)], id='IEAAYQ33JN%06d' % i, updatedDate=stamp)
+                self.timelogs.append(log)
+
+
+class FakeWrike(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, account, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.account = account
+        self.stats = defaultdict(int)  # {'calls.<endpoint>': n, 'bytes': n, 'wire_bytes': n}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(name='fake-wrike', target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def count(self, endpoint, raw, wire):
+        with self.stats_lock:
+            self.stats['calls.' + endpoint] += 1
+            self.stats['bytes'] += raw
+            self.stats['wire_bytes'] += wire
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats.clear()
+
+
+def _updated_since(records, params):
+    if 'updatedDate' not in params:
+        return records
+    start = json.loads(params['updatedDate']).get('start', '')
+    return [record for record in records if record['updatedDate'] >= start]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like www.wrike.com
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if self.path.startswith('/oauth2/token'):
+            return self.reply('oauth2/token', {'access_token': 'bench', 'refresh_token': 'bench', 'token_type': 'bearer', 'expires_in': 3600})
+        if re.match(r'/api/v3/folders/[^/]+/webhooks$', self.path):
+            return self.reply('folders/<id>/webhooks', {'data': [{'id': 'FAKEWEBHOOK', 'status': 'Active'}]})
+        return self.reply('unknown', {'error': 'not_found'}, 404)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        account = self.server.account
+        path = url.path[len('/api/v3'):]
+
+        with account.lock:
+            if path == '/accounts/%s/timelogs' % account_id:
+                return self.reply('accounts/<id>/timelogs', {'data': _updated_since(account.timelogs, params)})
+            if path == '/accounts/%s/tasks' % account_id:
+                return self.paginated('accounts/<id>/tasks', _updated_since(sorted(account.tasks.values(), key=lambda t: t['id']), params), params)
+            if path == '/accounts/%s/folders' % account_id:
+                return self.reply('accounts/<id>/folders', {'data': account.folders})
+            if path == '/accounts/%s/webhooks' % account_id:
+                return self.reply('accounts/<id>/webhooks', {'data': []})
+            match = re.match(r'/(tasks|contacts|users)/([^/]+)$', path)
+            if match:
+                kind, ids = match.group(1), match.group(2).split(',')
+                if len(ids) > 100 or (kind == 'users' and len(ids) > 1):
+                    return self.reply(kind + '/<ids>', {'error': 'invalid_parameter', 'errorDescription': 'too many ids'}, 400)
+                source = account.tasks if kind == 'tasks' else account.users
+                return self.reply(kind + '/<ids>', {'data': [source[i] for i in ids if i in source]})
+            match = re.match(r'/folders/([^/]+)/tasks$', path)
+            if match:
+                tasks = [task for task in account.tasks.values() if match.group(1) in task['parentIds']]
+                return self.paginated('folders/<id>/tasks', _updated_since(tasks, params), params)
+        return self.reply('unknown', {'error': 'not_found'}, 404)
+
+    def paginated(self, endpoint, records, params):
+        if 'pageSize' not in params:
+            return self.reply(endpoint, {'data': records})
+        size = int(params['pageSize'])
+        start = int(params.get('nextPageToken') or 0)
+        page = {'data': records[start:start + size]}
+        if start + size < len(records):
+            page['nextPageToken'] = str(start + size)
+        return self.reply(endpoint, page)
+
+    def reply(self, endpoint, payload, status=200):
+        body = json.dumps(payload)
+        raw = len(body)
+        gzipped = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        if gzipped:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=5) as f:
+                f.write(body)
+            body = buf.getvalue()
+        self.server.count(endpoint, raw, len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,185 @@
+"""
+Offline benchmark of the report pipelines against bench.fake_wrike and bench.fake_sheets:
+
+    python -m bench.run                      # 1k, 10k and 100k timelogs
+    python -m bench.run --timelogs 10000 --depth 12 --users 500 --json baseline.json
+
+Every stage runs in a forked child process, so its peak memory is its own. For each stage it reports wall time,
+Wrike calls by endpoint, bytes sent by the fake Wrike (raw json and on the wire), Sheets calls and cells, and peak RSS.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+work_dir = tempfile.mkdtemp(prefix='wrike-bench-')
+os.environ['wrike_cache_dir'] = work_dir  # before wrike is imported, it opens its caches there
+
+import cache  # noqa: E402
+import google  # noqa: E402
+import wrike  # noqa: E402
+from bench import fake_sheets, fake_wrike  # noqa: E402
+
+timelog_workbook_url = 'https://docs.google.com/spreadsheets/d/bench/edit'
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def setup_child(server, rate):
+    """ point this process at the fakes, with caches opened after the fork """
+    wrike.client = wrike.WrikeClient(wrike.creds, wrike.TokenBucket(rate, rate), pool_size=wrike.pool_size)
+    wrike.client.base_url = server.url + '/api/v3'
+    wrike.client.token_url = server.url + '/oauth2/token'
+    wrike.creds.access_token, wrike.creds.token_type = 'bench', 'bearer'
+    wrike.metadata_cache = cache.MetadataCache(os.path.join(work_dir, 'metadata.sqlite'), ttls=wrike.metadata_ttls)
+    google.pool = fake_sheets.FakePool()
+
+
+def run_stage(name, fn, server, rate):
+    """ run fn in a child process and collect its measurements """
+    server.reset_stats()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        result = {}
+        try:
+            sys.stdout = open(os.devnull, 'w')  # the pipeline prints progress
+            setup_child(server, rate)
+            baseline = rss_kb()
+            started = time.time()
+            result['detail'] = fn()
+            result['wall'] = time.time() - started
+            result['rss_baseline_kb'] = baseline
+            result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result['sheets'] = dict(fake_sheets.stats)
+        except Exception as e:
+            result['error'] = repr(e)
+        os.write(write_end, json.dumps(result))
+        os.close(write_end)
+        os._exit(0)
+
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    result = json.loads(''.join(chunks) or '{}')
+    result['name'] = name
+    result['wrike'] = dict(server.stats)
+    return result
+
+
+def stages(account):
+    def fetch_and_enrich(cold):
+        def stage():
+            if cold:
+                wrike.metadata_cache.invalidate()
+            return {'rows': len(wrike.get_timelog_table())}
+        return stage
+
+    def timelog_sync(full):
+        def stage():
+            if full:
+                wrike.timelog_sync.reset()
+            sheets = google.NewSession()
+            sheets.open_workbook(timelog_workbook_url)
+            sheets.open_worksheet('Sheet2')
+            return {'rows_written': wrike.timelog_sync.sync(sheets, start_row=2)}
+        return stage
+
+    def upload_table():
+        rows = [['2016-01-01 10:00:00', 'User', 'OPP-1', 'Project', 'Task %d' % i, '1.50', 'comment', 'https://x/%d' % i]
+                for i in range(len(account.timelogs))]
+        sheets = google.NewSession()
+        sheets.open_workbook(timelog_workbook_url)
+        sheets.open_worksheet('Upload')
+        sheets.upload_table(rows, start_row=2)
+        return {'rows': len(rows)}
+
+    def project_status():
+        table = wrike.get_project_details()
+        sheets = google.NewSession()
+        sheets.open_workbook(timelog_workbook_url)
+        sheets.open_worksheet('Project Status', force=True)
+        sheets.upload_table(table)
+        sheets.trim_rows(len(table))
+        return {'rows': len(table) - 1}
+
+    def tracker_cycle():
+        tracker = wrike.TrackAssessments()
+        tracker.do()
+        return {'pending': len(tracker.pending_requests)}
+
+    return [('fetch+enrich, cold cache', fetch_and_enrich(True), None),
+            ('fetch+enrich, warm cache', fetch_and_enrich(False), None),
+            ('timelog sync, full', timelog_sync(True), None),
+            ('timelog sync, 1% changed', timelog_sync(False), lambda: account.touch_timelogs(0.01, new=len(account.timelogs) // 100)),
+            ('upload_table', upload_table, None),
+            ('project status', project_status, None),
+            ('tracker cycle', tracker_cycle, None)]
+
+
+def print_result(result):
+    wrike_calls = sum(v for k, v in result['wrike'].items() if k.startswith('calls.'))
+    sheets = result.get('sheets', {})
+    sheet_calls = sum(v for k, v in sheets.items() if k.startswith('calls.'))
+    print '  %-28s %8.2fs  wrike %5d calls %9.1f KB (%8.1f KB wire)  sheets %4d calls %8d cells  peak %7.1f MB (+%.1f)%s' % (
+        result['name'], result.get('wall', 0), wrike_calls, result['wrike'].get('bytes', 0) / 1024.0,
+        result['wrike'].get('wire_bytes', 0) / 1024.0, sheet_calls, sheets.get('cells_written', 0),
+        result.get('peak_rss_kb', 0) / 1024.0, (result.get('peak_rss_kb', 0) - result.get('rss_baseline_kb', 0)) / 1024.0,
+        '  ERROR ' + result['error'] if 'error' in result else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline benchmark of the Wrike report pipelines')
+    parser.add_argument('--timelogs', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=6, help='super task levels under each project')
+    parser.add_argument('--rate', type=float, default=1e6, help='rate limit for the Wrike client, calls per second')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = OrderedDict()
+    try:
+        for size in args.timelogs:
+            account = fake_wrike.Account(timelogs=size, users=args.users, projects=args.projects, depth=args.depth)
+            server = fake_wrike.FakeWrike(account).start()
+            print '%d timelogs, %d tasks, %d users, depth %d' % (size, len(account.tasks), len(account.users), args.depth)
+            results[size] = []
+            for name, fn, before in stages(account):
+                if before:
+                    before()
+                result = run_stage(name, fn, server, args.rate)
+                print_result(result)
+                results[size].append(result)
+            server.shutdown()
+            server.server_close()
+            for name in os.listdir(work_dir):  # every size starts cold
+                os.remove(os.path.join(work_dir, name))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
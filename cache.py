@@ -0,0 +1,98 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class MetadataCache(object):
+    """
+    On-disk cache of Wrike entities (tasks, contacts, folders...) in a SQLite file.
+    Each kind of entity has its own time to live, and once there are more than max_entries rows the least recently
+    used ones are dropped. One connection is shared by every thread, guarded by a lock.
+    """
+    chunk_size = 500  # sqlite allows 999 bound variables per statement
+
+    def __init__(self, path, ttls=None, default_ttl=3600, max_entries=50000):
+        self.path = path
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entities ('
+                                    'kind TEXT, id TEXT, data TEXT, fetched_at REAL, last_used REAL, '
+                                    'PRIMARY KEY (kind, id))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entities_last_used ON entities (last_used)')
+            self.connection.commit()
+
+    def ttl(self, kind):
+        return self.ttls.get(kind, self.default_ttl)
+
+    def get_many(self, kind, ids):
+        """
+        :return: {id: entity} for the ids that are cached and still fresh
+        """
+        ids = list(set(ids))
+        found = {}
+        now = time.time()
+        oldest = now - self.ttl(kind)
+        with self.lock:
+            for i in range(0, len(ids), self.chunk_size):
+                chunk = ids[i:i + self.chunk_size]
+                rows = self.connection.execute('SELECT id, data FROM entities WHERE kind = ? AND fetched_at >= ? AND id IN (%s)'
+                                               % ','.join('?' * len(chunk)), [kind, oldest] + chunk).fetchall()
+                for entity_id, data in rows:
+                    found[entity_id] = json.loads(data)
+            found_ids = list(found)
+            for i in range(0, len(found_ids), self.chunk_size):
+                chunk = found_ids[i:i + self.chunk_size]
+                self.connection.execute('UPDATE entities SET last_used = ? WHERE kind = ? AND id IN (%s)'
+                                        % ','.join('?' * len(chunk)), [now, kind] + chunk)
+            self.connection.commit()
+        return found
+
+    def get(self, kind, entity_id):
+        return self.get_many(kind, [entity_id]).get(entity_id)
+
+    def put_many(self, kind, entities):
+        """
+        :param entities: {id: entity}
+        """
+        if not entities:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO entities (kind, id, data, fetched_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                                        [(kind, entity_id, json.dumps(entity), now, now) for entity_id, entity in entities.items()])
+            self._evict()
+            self.connection.commit()
+
+    def put(self, kind, entity_id, entity):
+        self.put_many(kind, {entity_id: entity})
+
+    def invalidate(self, kind=None, ids=None):
+        """ drop the given ids of one kind, every entry of one kind, or everything """
+        with self.lock:
+            if kind is None:
+                self.connection.execute('DELETE FROM entities')
+            elif ids is None:
+                self.connection.execute('DELETE FROM entities WHERE kind = ?', (kind,))
+            else:
+                ids = list(ids)
+                for i in range(0, len(ids), self.chunk_size):
+                    chunk = ids[i:i + self.chunk_size]
+                    self.connection.execute('DELETE FROM entities WHERE kind = ? AND id IN (%s)' % ','.join('?' * len(chunk)),
+                                            [kind] + chunk)
+            self.connection.commit()
+
+    def _evict(self):
+        count = self.connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute('DELETE FROM entities WHERE rowid IN '
+                                    '(SELECT rowid FROM entities ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
@@ -1,44 +1,174 @@
+import httplib
 import json
 import os
-import sys
+import re
+import socket
+import threading
 import time
+from datetime import datetime, timedelta
 
 import gspread
+import httplib2
+import requests
 from oauth2client.client import SignedJwtAssertionCredentials
 
+import metrics
+import retries
+
+sheets_seconds = metrics.histogram('sheets_call_seconds', 'Time spent in each NewSession method, including its retries.', ['method'])
+sheets_cells_written = metrics.counter('sheets_cells_written_total', 'Cells sent to Google Sheets.')
+
+
+# the errors gspread raises for a failed request: RequestError and its HTTPError up to 0.6, APIError from 3.0
+_request_errors = tuple(getattr(gspread.exceptions, name) for name in ('RequestError', 'APIError') if hasattr(gspread.exceptions, name))
+
+
+def sheets_status(error):
+    """
+    The HTTP status of a failed gspread request, or None when it does not say. Each gspread version carries it
+    differently: .code (HTTPError, 0.3 to 0.5), the first argument (RequestError, 0.6), a '<status>: ...' message
+    (0.4 re-raises HTTPError as RequestError(message)) or .response (APIError, 3.x).
+    """
+    if not isinstance(error, _request_errors):
+        return None
+    status = getattr(error, 'code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is None and error.args:
+        first = error.args[0]
+        if isinstance(first, basestring):
+            match = re.match(r'(\d{3})\b', first)
+            first = match.group(1) if match else None
+        status = first
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_sheets_error(error):
+    """
+    rejected authorization, throttling, server and network errors are worth retrying, anything else is not.
+    A failed request that does not say its status is retried.
+    """
+    if isinstance(error, (gspread.AuthenticationError, retries.RetryableError)):
+        return 'retry'
+    if isinstance(error, _request_errors):
+        status = sheets_status(error)
+        return 'retry' if status is None or status in (401, 408, 429) or status >= 500 else 'fatal'
+    if isinstance(error, (requests.RequestException, socket.error, httplib.HTTPException)):
+        return 'retry'
+    return 'fatal'
+
+
+def is_auth_error(error):
+    return isinstance(error, gspread.AuthenticationError) or sheets_status(error) == 401
+
+
+sheets_epoch = datetime(1899, 12, 30)  # day 0 of the serial numbers Sheets keeps dates as
+_date_text = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?: (\d\d):(\d\d):(\d\d))?$')
+
+sheets_policy = retries.Policy('sheets', attempts=int(os.environ.get('sheets_retry_attempts', 5)), base=1.0, cap=30.0,
+                               deadline=float(os.environ.get('sheets_retry_deadline', 300)), classify=classify_sheets_error)
+
 
 def retry(fn):
+    """
+    Retry a NewSession method on transient Sheets errors, backing off as sheets_policy says and refreshing the
+    authorization when it was rejected. Other errors are raised.
+    Only for methods that make a single Sheets call: a retried method made of several calls would redo the writes that
+    had succeeded, and the retries of its calls would multiply with its own.
+    """
     def wrapper(*args, **kwargs):
-        tries = 3
-        while tries > 0:
-            try:
-                return fn(*args, **kwargs)
-            except gspread.AuthenticationError:
+        def on_retry(error, delay):
+            if is_auth_error(error):
                 args[0].refresh()
-                tries -= 1
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback_template = '''Traceback (most recent call last):
-                  File "%(filename)s", line %(lineno)s, in %(name)s
-                %(type)s: %(message)s\n'''
-
-                traceback_details = {
-                    'filename': exc_traceback.tb_frame.f_code.co_filename,
-                    'lineno': exc_traceback.tb_lineno,
-                    'name': exc_traceback.tb_frame.f_code.co_name,
-                    'type': exc_type.__name__,
-                    'message': exc_value.message,  # or see traceback._some_str()
-                }
-
-                print 'Error\n' + traceback_template % traceback_details
-                tries -= 1
+        return sheets_policy.call(fn, *args, on_retry=on_retry, operation='sheets ' + fn.__name__, **kwargs)
 
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
     return wrapper
 
 
+class ClientPool(object):
+    """
+    One authorized gspread client for the whole process, shared by every NewSession, plus the workbook and worksheet
+    handles opened through it, cached by URL and by (URL, sheet name) for handle_ttl seconds.
+    The token is refreshed in place when it is within `margin` seconds of expiry, so cached handles stay usable;
+    after an AuthenticationError reset() drops everything and the next call authorizes again.
+    """
+    scope = ['https://spreadsheets.google.com/feeds']
+
+    def __init__(self, key_file='google_key.json', margin=300, handle_ttl=600):
+        self.key_file = key_file
+        self.margin = margin
+        self.handle_ttl = handle_ttl
+        self.lock = threading.RLock()
+        self.credentials = None
+        self.client = None
+        self.workbooks = {}  # {url: (workbook, opened at)}
+        self.worksheets = {}  # {(url, sheet name): (worksheet, opened at)}
+
+    def _new_auth(self):
+        if os.path.isfile(self.key_file):
+            json_key = json.load(open(self.key_file))
+        else:
+            json_key = {}
+        client_email = json_key['client_email']
+        private_key = json_key['private_key'].encode()
+        self.credentials = SignedJwtAssertionCredentials(client_email, private_key, self.scope)
+        self.client = gspread.authorize(self.credentials)
+
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                self._new_auth()
+            elif self.credentials.token_expiry and self.credentials.token_expiry - datetime.utcnow() < timedelta(seconds=self.margin):
+                self.credentials.refresh(httplib2.Http())
+                self.client.login()  # puts the new token on the existing session
+            return self.client
+
+    def reset(self):
+        with self.lock:
+            self.credentials = None
+            self.client = None
+            self.workbooks = {}
+            self.worksheets = {}
+
+    def _cached(self, cache, key):
+        handle, opened = cache.get(key, (None, 0))
+        return handle if time.time() - opened < self.handle_ttl else None
+
+    def workbook(self, url):
+        with self.lock:
+            client = self.get_client()
+            workbook = self._cached(self.workbooks, url)
+            if workbook is None:
+                workbook = client.open_by_url(url)
+                self.workbooks[url] = (workbook, time.time())
+            return workbook
+
+    def worksheet(self, url, sheet_name, force=False):
+        """ :param force: add the worksheet when the workbook does not have it """
+        with self.lock:
+            worksheet = self._cached(self.worksheets, (url, sheet_name))
+            if worksheet is None:
+                workbook = self.workbook(url)
+                try:
+                    worksheet = workbook.worksheet(sheet_name)
+                except gspread.WorksheetNotFound:
+                    if force:
+                        worksheet = workbook.add_worksheet(sheet_name, 1, 1)
+                    else:
+                        raise
+                self.worksheets[(url, sheet_name)] = (worksheet, time.time())
+            return worksheet
+
+
+pool = ClientPool()
+
+
 class NewSession(object):
-    client_email = ''
-    private_key = ''
     client = None
     workbook = None
     workbook_URL = ''
@@ -55,79 +185,79 @@ class NewSession(object):
             self.row = row
 
     def __init__(self):
-        if os.path.isfile('google_key.json'):
-            json_key = json.load(open('google_key.json'))
-            self.client_email = json_key['client_email']
-            self.private_key = json_key['private_key'].encode()
-            self._new_auth()
-        else:
-            json_key = {}
-            self.client_email = json_key['client_email']
-            self.private_key = json_key['private_key'].encode()
-            self._new_auth()
-
-    def _new_auth(self):
-        scope = ['https://spreadsheets.google.com/feeds']
-        credentials = SignedJwtAssertionCredentials(self.client_email, self.private_key, scope)
-        self.client = gspread.authorize(credentials)
+        self.client = pool.get_client()
 
     def refresh(self):
-        self._new_auth()
+        """ authorize again and reopen the workbook and worksheet, called between the attempts of a retried call """
+        pool.reset()
         try:
+            self.client = pool.get_client()
             if self.workbook_URL:
-                self.open_workbook(self.workbook_URL)
+                self.workbook = pool.workbook(self.workbook_URL)
                 if self.worksheet_name:
-                    self.open_worksheet(self.worksheet_name)
-        except gspread.GSpreadException:
-            pass
+                    self.worksheet = pool.worksheet(self.workbook_URL, self.worksheet_name)
+        except Exception as e:
+            if classify_sheets_error(e) != 'retry' and not isinstance(e, gspread.GSpreadException):
+                raise
+            print 'refresh failed:', repr(e)  # the next attempt fails the same way and is retried
 
     @retry
+    @metrics.timed(sheets_seconds)
     def open_workbook(self, URL):
         self.workbook_URL = URL
-        self.workbook = self.client.open_by_url(self.workbook_URL)
+        self.workbook = pool.workbook(self.workbook_URL)
 
     @retry
+    @metrics.timed(sheets_seconds)
     def open_worksheet(self, sheet_name, force=False):
         self.worksheet_name = sheet_name
-        try:
-            self.worksheet = self.workbook.worksheet(self.worksheet_name)
-        except gspread.WorksheetNotFound:
-            if force:
-                self.worksheet = self.workbook.add_worksheet(sheet_name, 1, 1)
-            else:
-                raise
+        self.worksheet = pool.worksheet(self.workbook_URL, self.worksheet_name, force=force)
 
     @retry
+    @metrics.timed(sheets_seconds)
     def append_row(self, list_of_values):
         self.worksheet.append_row(list_of_values)
 
     @retry
+    @metrics.timed(sheets_seconds)
+    def col_values(self, col):
+        return self.worksheet.col_values(col)
+
+    @metrics.timed(sheets_seconds)
+    def append_rows(self, list_of_lists):
+        """
+        append rows below the last row of the sheet like append_row does, as one batched range write.
+        Not retried as a whole, its resize and each of its blocks are, so rows are never appended twice.
+        """
+        if list_of_lists:
+            self.upload_table(list_of_lists, start_row=self.worksheet.row_count + 1, shrink_cols=False)
+
+    @retry
+    @metrics.timed(sheets_seconds)
     def clear_sheet(self):
         self.worksheet.resize(cols=self.worksheet.col_count, rows=2)
 
     @retry
-    def _get_selection(self, cols, rows, start_col=1, start_row=1):
-        cell_list = None
+    @metrics.timed(sheets_seconds)
+    def _fit_selection(self, cols, rows, start_col=1, start_row=1, shrink_cols=True):
+        """
+        resize the sheet so the selection fits: at least as tall as its last row, and exactly as wide as its last column
+        (or at least as wide, without shrink_cols). No call is made when the sheet already has that size.
+        """
+        end_cell = self._Cell(start_col + cols - 1, start_row + rows - 1)
+        end_col = end_cell.col if shrink_cols else max(end_cell.col, self.worksheet.col_count)
+        end_row = max(end_cell.row, self.worksheet.row_count)
+        if (end_col, end_row) != (self.worksheet.col_count, self.worksheet.row_count):
+            self.worksheet.resize(cols=end_col, rows=end_row)
 
+    @metrics.timed(sheets_seconds)
+    def _get_selection(self, cols, rows, start_col=1, start_row=1):
+        """ the cells of a range; blocks written by _run_blocks read theirs with this, retried with the block """
         start_cell = self._Cell(start_col, start_row)
         end_cell = self._Cell(start_col + cols - 1, start_row + rows - 1)
-
-        row_count = end_cell.row - start_cell.row + 1
-        col_count = end_cell.col - start_cell.col + 1
-        cell_count = row_count * col_count
-
-        self.worksheet.resize(cols=end_cell.col, rows=end_cell.row if end_cell.row >= self.worksheet.row_count else self.worksheet.row_count)
-
-        if cell_count > self.batch_size:
-            # TODO need to write batching
-            print 'too big'
-            pass
-        else:
-            print 'cell count', cell_count
-            area = self.worksheet.get_addr_int(start_cell.row, start_cell.col) + ':' + self.worksheet.get_addr_int(end_cell.row, end_cell.col)
-            cell_list = self.worksheet.range(area)
-        # print 'get', type(cell_list)
-        return cell_list
+        print 'cell count', rows * cols
+        area = self.worksheet.get_addr_int(start_cell.row, start_cell.col) + ':' + self.worksheet.get_addr_int(end_cell.row, end_cell.col)
+        return self.worksheet.range(area)
 
     def _rewrite_cell_list(self, input_data, cell_list):
         index = 0
@@ -137,39 +267,251 @@ class NewSession(object):
                     cell_list[index].value = data.encode('utf-8') if data else ''  # may need str(data).decode('utf-8')
                 # elif type(data) == unicode:
                 #     cell_list[index].value = data.decode('utf-8') if data else ''
+                elif isinstance(data, (int, long, float)) and not isinstance(data, bool):
+                    cell_list[index].value = data  # a count of 0 is written as 0, not left blank
                 else:
                     cell_list[index].value = data if data else ''
 
                 index += 1
         return cell_list
 
-    def upload_table(self, list_of_lists, start_col=1, start_row=1):
+    @metrics.timed(sheets_seconds)
+    def upload_table(self, list_of_lists, start_col=1, start_row=1, shrink_cols=True):
+        """
+        Write a table in blocks of whole rows of at most batch_size cells. Each block's range is fetched and written on
+        its own, so only one block of cells is held at a time, and when a block fails only the failed blocks are retried.
+        :param shrink_cols: drop the sheet's columns right of the table
+        """
         if len(list_of_lists) == 0:
             list_of_lists = [['']]
         rows = len(list_of_lists)
         cols = len(list_of_lists[0])
-        selection = self._get_selection(cols, rows, start_col=start_col, start_row=start_row)
-        # print 'selection' , type(selection)
-        cell_list_payload = self._rewrite_cell_list(list_of_lists, selection)
-        self._upload_data(cell_list_payload)
+        self._fit_selection(cols, rows, start_col=start_col, start_row=start_row, shrink_cols=shrink_cols)
 
-    def _upload_data(self, cell_list):
-        finished = False
-        index = 0
-        attempts = 5
-
-        while not finished:
-            try:
-                self.worksheet.update_cells(cell_list[0 + index:self.batch_size + index])
-                index += self.batch_size
-                if index > len(cell_list):  # need to consider if its exact TODO
-                    finished = True
-            except:
-                attempts -= 1
-                if attempts < 1:
-                    finished = True
-                time.sleep(3)
+        def upload_block(offset):
+            block = list_of_lists[offset:offset + rows_per_block]
+            selection = self._get_selection(cols, len(block), start_col=start_col, start_row=start_row + offset)
+            self.worksheet.update_cells(self._rewrite_cell_list(block, selection))
+            sheets_cells_written.inc(len(selection))
+
+        rows_per_block = max(1, self.batch_size // cols)
+        self._run_blocks(upload_block, range(0, rows, rows_per_block))  # first row of each block, relative to start_row
+
+    def _run_blocks(self, fn, blocks):
+        """
+        Call fn(block) for every block. When some fail with a retryable error, back off as sheets_policy says and
+        resume with only the blocks that failed; an error that retrying cannot fix is raised straight away.
+        """
+        pending = list(blocks)
+
+        def run_pending():
+            failed = []
+            for block in pending:
+                try:
+                    fn(block)
+                except Exception as e:
+                    if classify_sheets_error(e) != 'retry':
+                        raise
+                    if is_auth_error(e):
+                        self.refresh()
+                    print 'block', block, 'failed:', repr(e)
+                    failed.append(block)
+            pending[:] = failed
+            if failed:
+                raise retries.RetryableError('{} of {} blocks failed'.format(len(failed), len(blocks)))
+
+        sheets_policy.call(run_pending, operation='sheets blocks')
+
+    @staticmethod
+    def _as_text(value):
+        """ the text a value ends up as in a cell, empty values are written as '' (numbers, 0 included, are not empty) """
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            return unicode(value)
+        if not value:
+            return u''
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        return unicode(value)
+
+    def _cell_text(self, cell):
+        """ the text a cell was entered with """
+        return self._as_text(cell.input_value if getattr(cell, 'input_value', None) is not None else cell.value)
+
+    @staticmethod
+    def _as_number(text):
+        """ the number Sheets parses text as: a number, or the serial day of a 'YYYY-MM-DD HH:MM:SS' date; None otherwise """
+        try:
+            number = float(text)
+            return number if number == number and abs(number) != float('inf') else None
+        except ValueError:
+            pass
+        match = _date_text.match(text)
+        if match is None:
+            return None
+        try:
+            date = datetime(*[int(part) for part in match.groups() if part is not None])
+        except ValueError:
+            return None
+        return (date - sheets_epoch).total_seconds() / 86400
+
+    def _holds(self, cell, text):
+        """
+        whether a cell already shows text. Sheets parses the numbers and dates written to it, so they read back in its
+        own format ('1.50' as '1.5', dates in the sheet's locale); those are compared by the number the cell holds.
+        """
+        if self._cell_text(cell) == text:
+            return True
+        number = getattr(cell, 'numeric_value', None)
+        if number is None or not text:
+            return False
+        written = self._as_number(text)
+        return written is not None and abs(written - number) < 1e-6  # a second is 1.2e-5 of a day
+
+    def _changed_cells(self, cells, values):
+        """ set the cells of one sheet row that differ from values (blank past its end) and return them """
+        changed = []
+        for col, cell in enumerate(cells):
+            text = self._as_text(values[col] if col < len(values) else '')
+            if not self._holds(cell, text):
+                cell.value = text
+                changed.append(cell)
+        return changed
+
+    def _update_cells(self, changed):
+        """ send changed cells in update_cells calls of at most batch_size cells """
+        print 'changed cells', len(changed)
+
+        def update_block(offset):
+            self.worksheet.update_cells(changed[offset:offset + self.batch_size])
+            sheets_cells_written.inc(len(changed[offset:offset + self.batch_size]))
+
+        self._run_blocks(update_block, range(0, len(changed), self.batch_size))
+
+    @retry
+    def _read_selection(self, cols, rows, start_col=1, start_row=1):
+        """ _get_selection for a read that is not part of a block, retried on its own """
+        return self._get_selection(cols, rows, start_col=start_col, start_row=start_row)
+
+    def _get_cell_rows(self, cols, rows, start_col=1, start_row=1):
+        """ read a range in blocks of at most batch_size cells, returned as a list of rows of cells """
+        cell_rows = []
+        rows_per_block = max(1, self.batch_size // cols)
+        for offset in range(0, rows, rows_per_block):
+            block_rows = min(rows_per_block, rows - offset)
+            cells = self._read_selection(cols, block_rows, start_col=start_col, start_row=start_row + offset)
+            cell_rows.extend(cells[i:i + cols] for i in range(0, len(cells), cols))
+        return cell_rows
+
+    @staticmethod
+    def _keyed_layout(list_of_lists, current_keys, key_index):
+        """
+        Place the new rows on the sheet rows they already occupy, matched by key. Inserted rows take the rows freed by
+        deleted keys first and are appended after that; if rows are still free, rows from the bottom move up into them.
+        :return: the new rows in sheet order
+        """
+        position_of = {}
+        for position, key in enumerate(current_keys):
+            if key and key not in position_of:
+                position_of[key] = position
+
+        layout = [None] * len(current_keys)
+        inserted = []
+        for row in list_of_lists:
+            key = NewSession._as_text(row[key_index] if key_index < len(row) else '')
+            position = position_of.pop(key, None)
+            if position is None:
+                inserted.append(row)
+            else:
+                layout[position] = row
+
+        inserted.reverse()
+        for position in range(len(layout)):
+            if layout[position] is None and inserted:
+                layout[position] = inserted.pop()
+        layout.extend(reversed(inserted))
+
+        low, high = 0, len(layout) - 1
+        while True:
+            while low < len(layout) and layout[low] is not None:
+                low += 1
+            while high >= 0 and layout[high] is None:
+                high -= 1
+            if low >= high:
+                break
+            layout[low], layout[high] = layout[high], None
+        return layout[:high + 1]
+
+    @metrics.timed(sheets_seconds)
+    def sync_table(self, list_of_lists, start_col=1, start_row=1, key_col=None, trim=True):
+        """
+        Make the sheet show list_of_lists by reading the current range once and sending only the cells that differ.
+        With key_col (1 based column of the table) rows are matched by that key, so a row that is still there keeps its
+        sheet row, see _keyed_layout. Without it rows are compared by position.
+        :param trim: remove the sheet rows below the table; leave it off when syncing a long table one slice at a time
+        :return: the number of cells written
+        """
+        cols = max([len(row) for row in list_of_lists] + [1])
+        existing_rows = max(0, self.worksheet.row_count - start_row + 1)
+        height = max(existing_rows, len(list_of_lists)) if (trim or key_col) else len(list_of_lists)
+        if height == 0:
+            return 0
+        self._fit_selection(cols, height, start_col=start_col, start_row=start_row)
+        cell_rows = self._get_cell_rows(cols, height, start_col=start_col, start_row=start_row)
+
+        if key_col:
+            list_of_lists = self._keyed_layout(list_of_lists, [self._cell_text(cells[key_col - 1]) for cells in cell_rows], key_col - 1)
+        final_rows = max(len(list_of_lists), 1)  # a sheet keeps at least one row, blank it if the table is empty
+
+        changed = []
+        for position, cells in enumerate(cell_rows[:final_rows]):
+            changed.extend(self._changed_cells(cells, list_of_lists[position] if position < len(list_of_lists) else []))
+        del cell_rows
+
+        self._update_cells(changed)
+        if trim and height > final_rows:
+            self.trim_rows(start_row - 1 + final_rows)
+        return len(changed)
+
+    @metrics.timed(sheets_seconds)
+    def write_rows(self, rows_by_position, start_col=1, start_row=1):
+        """
+        Write rows scattered over the sheet, {position: row} with positions counted from start_row, the way sync_table
+        writes a table: one resize when rows go past the end of the sheet, one read per block of batch_size cells that
+        holds a changed row (from its first to its last changed row), and only the cells that differ are sent, in
+        update_cells calls of batch_size cells.
+        :return: the number of cells written
+        """
+        if not rows_by_position:
+            return 0
+        positions = sorted(rows_by_position)
+        cols = max(len(row) for row in rows_by_position.values())
+        self._fit_selection(cols, positions[-1] + 1, start_col=start_col, start_row=start_row, shrink_cols=False)
+
+        rows_per_block = max(1, self.batch_size // cols)
+        changed = []
+        first = 0
+        while first < len(positions):
+            last = first
+            while last + 1 < len(positions) and positions[last + 1] // rows_per_block == positions[first] // rows_per_block:
+                last += 1
+            span = positions[last] - positions[first] + 1
+            cells = self._read_selection(cols, span, start_col=start_col, start_row=start_row + positions[first])
+            for position in positions[first:last + 1]:
+                offset = (position - positions[first]) * cols
+                changed.extend(self._changed_cells(cells[offset:offset + cols], rows_by_position[position]))
+            first = last + 1
+
+        self._update_cells(changed)
+        return len(changed)
+
+    @retry
+    @metrics.timed(sheets_seconds)
+    def trim_rows(self, last_row):
+        """ remove every row below last_row """
+        if self.worksheet.row_count > last_row:
+            self.worksheet.resize(cols=self.worksheet.col_count, rows=max(last_row, 1))
 
+    @metrics.timed(sheets_seconds)
     def find(self, text):
         try:
             return self.worksheet.find(text)
@@ -0,0 +1,125 @@
+import Queue
+import itertools
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+_local = threading.local()
+
+
+def progress(message):
+    """ record the progress of the job running on this thread, a message or a dict of state; does nothing outside of a job """
+    job = getattr(_local, 'job', None)
+    if job:
+        job.progress = message
+
+
+class Job(object):
+    def __init__(self, job_id, key, fn, args, kwargs):
+        self.id = job_id
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'  # queued, running, done or failed
+        self.progress = ''
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def duration(self):
+        if not self.started:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        return {'id': self.id,
+                'key': self.key,
+                'status': self.status,
+                'progress': self.progress,
+                'duration': round(self.duration(), 3),
+                'queued_for': round((self.started or time.time()) - self.submitted, 3),
+                'result': self.result,
+                'error': self.error}
+
+    def run(self):
+        _local.job = self
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+            self.status = 'done'
+        except Exception:
+            self.error = traceback.format_exc()
+            self.status = 'failed'
+            print 'job', self.key, 'failed\n' + self.error
+        finally:
+            self.finished = time.time()
+            _local.job = None
+
+
+class JobScheduler(object):
+    """
+    Runs report jobs on a bounded pool of worker threads, so a route can return as soon as its job is queued.
+    Submitting a key that is still queued or running returns the job already in flight instead of a new one.
+    Loops that never finish, like the assessment tracker, run as singletons on a thread of their own.
+    """
+
+    def __init__(self, workers=2, history=100):
+        self.queue = Queue.Queue()
+        self.jobs = OrderedDict()  # every job by id, finished ones are dropped past `history`
+        self.in_flight = {}  # queued or running job by key
+        self.history = history
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        for i in range(workers):
+            worker = threading.Thread(name='job-worker-{}'.format(i), target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _new_job(self, key, fn, args, kwargs):
+        job = Job(str(next(self.ids)), key, fn, args, kwargs)
+        self.jobs[job.id] = job
+        self.in_flight[key] = job
+        finished = [job_id for job_id, old in self.jobs.items() if old.finished]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+        return job
+
+    def submit(self, key, fn, *args, **kwargs):
+        """ queue fn(*args, **kwargs) on the worker pool, unless a job with the same key is in flight """
+        with self.lock:
+            if key in self.in_flight:
+                return self.in_flight[key]
+            job = self._new_job(key, fn, args, kwargs)
+        self.queue.put(job)
+        return job
+
+    def singleton(self, key, fn, *args, **kwargs):
+        """ run fn on its own thread, unless it is already running """
+        with self.lock:
+            if key in self.in_flight:
+                return self.in_flight[key]
+            job = self._new_job(key, fn, args, kwargs)
+        thread = threading.Thread(name=key, target=self._run, args=(job,))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _run(self, job):
+        try:
+            job.run()
+        finally:
+            with self.lock:
+                if self.in_flight.get(job.key) is job:
+                    del self.in_flight[job.key]
+
+    def _work(self):
+        while True:
+            self._run(self.queue.get())
@@ -0,0 +1,192 @@
+import functools
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_metrics = OrderedDict()  # every metric by name, in the order they were declared
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ a value per combination of labels that only goes up """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name + _format_labels(self.labelnames, key), value
+
+
+class Histogram(object):
+    """ counts of observations per bucket (cumulative, like Prometheus), with their sum, per combination of labels """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = {}  # {label values: (count per bucket, sum)}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + '_bucket' + _format_labels(self.labelnames, key, [('le', _format_value(bound))]), count
+            yield self.name + '_sum' + _format_labels(self.labelnames, key), total
+            yield self.name + '_count' + _format_labels(self.labelnames, key), counts[-1]
+
+
+class Gauge(object):
+    """ a value read from a function each time the metrics are rendered, e.g. the state of the rate limiter """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def samples(self):
+        yield self.name, self.read()
+
+
+def _register(metric):
+    with _lock:
+        return _metrics.setdefault(metric.name, metric)
+
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=default_buckets):
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge(name, documentation, read):
+    return _register(Gauge(name, documentation, read))
+
+
+def render():
+    """ every metric in the Prometheus text exposition format """
+    lines = []
+    for metric in _metrics.values():
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        with _lock:
+            samples = list(metric.samples())
+        lines.extend('{} {}'.format(name, _format_value(value)) for name, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+_id_segment = re.compile(r'^[A-Z0-9]{8,}(,[A-Z0-9]{8,})*$')
+
+
+def endpoint(call):
+    """ a Wrike call with its ids taken out, so every call to '/tasks/<ids>' is counted as one endpoint """
+    return '/'.join('{id}' if _id_segment.match(segment) else segment for segment in call.split('?')[0].split('/'))
+
+
+def timed(metric, **labels):
+    """ decorator that observes how long each call of the function takes, labelled with method=<function name> """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metric.time(method=fn.__name__, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PhaseTimer(object):
+    """
+    Wall time of the phases of one run, e.g. one tracker cycle, kept for a summary at the end of the run and also
+    observed in the `phase_seconds` histogram (labelled with the run's name and the phase).
+
+        phases = PhaseTimer('tracker')
+        with phases('get_pending'):
+            ...
+        print phases.summary()
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def __call__(self, phase):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+            phase_seconds.observe(elapsed, run=self.name, phase=phase)
+
+    def iterate(self, phase, iterable):
+        """ yield from iterable, counting the time spent getting each item as `phase` """
+        iterator = iter(iterable)
+        while True:
+            with self(phase):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def summary(self):
+        """ e.g. 'tracker 1.92s: get_pending 0.31s, append_new 0.80s, ...' """
+        return '{} {:.2f}s: {}'.format(self.name, time.time() - self.started,
+                                        ', '.join('{} {:.2f}s'.format(phase, seconds) for phase, seconds in self.phases.items()))
+
+
+phase_seconds = histogram('report_phase_seconds', 'Time spent in each phase of a report run or tracker cycle.', ['run', 'phase'])
@@ -0,0 +1,81 @@
+import functools
+import random
+import time
+
+import metrics
+
+retries_total = metrics.counter('retries_total', 'Operations tried again after a retryable error, by operation and error.', ['operation', 'error'])
+retry_wait = metrics.counter('retry_wait_seconds_total', 'Time spent backing off before retries.', ['operation'])
+retries_exhausted = metrics.counter('retries_exhausted_total', 'Operations that gave up after their last attempt or their deadline.', ['operation'])
+
+
+class RetryableError(Exception):
+    """ raised by an attempt that may succeed if it is tried again, after retry_after seconds when that is known """
+
+    def __init__(self, message, retry_after=None):
+        super(RetryableError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class Policy(object):
+    """
+    How one kind of operation is retried: at most `attempts` attempts, all within `deadline` seconds of the first one.
+    Between attempts it sleeps for a random time between 0 and base * 2^n, capped at `cap` ("full jitter", so clients
+    that failed together do not retry together), or for the retry_after of the error when the server asked for one.
+
+    classify(error) decides what an exception means:
+        'retry'  -> back off and try again
+        'fatal'  -> raise it now, trying again would not help
+    By default only RetryableError is retried.
+    """
+
+    def __init__(self, name, attempts=5, base=0.5, cap=20.0, deadline=120.0, classify=None):
+        self.name = name
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.classify = classify or (lambda error: 'retry' if isinstance(error, RetryableError) else 'fatal')
+
+    def backoff(self, attempt, error=None):
+        """ seconds to wait after failed attempt number `attempt` (0 based) """
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def call(self, fn, *args, **kwargs):
+        """
+        fn(*args, **kwargs) with retries. The last error is raised when it is fatal, when the attempts are used up, or when
+        the next backoff would end past the deadline.
+        :param on_retry: keyword only, called as on_retry(error, delay) before each backoff, e.g. to refresh a token
+        :param operation: keyword only, what the metrics and log call the operation, the policy's name by default
+        """
+        on_retry = kwargs.pop('on_retry', None)
+        operation = kwargs.pop('operation', None) or self.name
+        deadline = time.time() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if self.classify(e) != 'retry':
+                    raise
+                delay = self.backoff(attempt, e)
+                attempt += 1
+                if attempt >= self.attempts or time.time() + delay > deadline:
+                    retries_exhausted.inc(operation=operation)
+                    raise
+                print 'retrying {} in {:.1f}s after {!r}'.format(operation, delay, e)
+                retries_total.inc(operation=operation, error=type(e).__name__)
+                retry_wait.inc(delay, operation=operation)
+                if on_retry:
+                    on_retry(e, delay)
+                time.sleep(delay)
+
+    def __call__(self, fn):
+        """ decorator form of call """
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self.call(fn, *args, **kwargs)
+        return wrapper
@@ -0,0 +1,74 @@
+import gzip
+import json
+import os
+import re
+import threading
+import time
+
+
+class Snapshot(object):
+    def __init__(self, name, version, created, rows):
+        self.name = name
+        self.version = version
+        self.created = created
+        self.rows = rows
+
+    def age(self):
+        return time.time() - self.created
+
+
+class SnapshotStore(object):
+    """
+    Versioned report tables on disk, one gzipped json file per version: <directory>/<name>-<version>.json.gz
+    A version is written to a temporary file and renamed into place, so readers only ever see whole snapshots,
+    and only the newest `keep` versions of each report are kept. The latest version of each report is also kept
+    in memory until a newer one is saved.
+    """
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.loaded = {}  # {name: Snapshot}, the latest version read or written
+
+    def _versions(self, name):
+        """ versions of a report on disk, newest first """
+        if not os.path.isdir(self.directory):
+            return []
+        pattern = re.compile(re.escape(name) + r'-(\d+)\.json\.gz$')
+        versions = [int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match]
+        return sorted(versions, reverse=True)
+
+    def _path(self, name, version):
+        return os.path.join(self.directory, '{}-{}.json.gz'.format(name, version))
+
+    def save(self, name, rows):
+        """ write rows as the newest version of report `name` and return its Snapshot """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        created = time.time()
+        with self.lock:
+            version = max([int(created * 1000)] + [v + 1 for v in self._versions(name)[:1]])
+            path = self._path(name, version)
+            with gzip.open(path + '.tmp', 'wb') as f:
+                json.dump({'name': name, 'version': version, 'created': created, 'rows': rows}, f)
+            os.rename(path + '.tmp', path)
+            for old in self._versions(name)[self.keep:]:
+                os.remove(self._path(name, old))
+            snapshot = Snapshot(name, version, created, rows)
+            self.loaded[name] = snapshot
+        return snapshot
+
+    def latest(self, name):
+        """ the newest Snapshot of report `name`, or None if there is none yet """
+        with self.lock:
+            versions = self._versions(name)
+            if not versions:
+                return None
+            snapshot = self.loaded.get(name)
+            if snapshot is None or snapshot.version != versions[0]:
+                with gzip.open(self._path(name, versions[0]), 'rb') as f:
+                    data = json.load(f)
+                snapshot = Snapshot(name, data['version'], data['created'], data['rows'])
+                self.loaded[name] = snapshot
+            return snapshot
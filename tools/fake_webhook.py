@@ -0,0 +1,39 @@
+"""
+Send Wrike style webhook events to a local app, to test the event driven assessment tracker without Wrike:
+
+    python tools/fake_webhook.py http://localhost:8080/wrike/webhook IEAAYQ33KQC4HFGQ [more task ids] --secret s [--event TaskParentsRemoved]
+
+--secret must match the app's wrike_webhook_secret, the payload is signed with it like Wrike does (X-Hook-Signature);
+the app refuses unsigned posts.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+from datetime import datetime
+
+import requests
+
+
+def send(url, task_ids, event_type='TaskStatusChanged', secret=None):
+    now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    body = json.dumps([{'webhookId': 'FAKEWEBHOOK',
+                        'eventAuthorId': 'FAKEUSER',
+                        'eventType': event_type,
+                        'taskId': task_id,
+                        'lastUpdatedDate': now} for task_id in task_ids])
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Hook-Signature'] = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return requests.post(url, data=body, headers=headers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='send fake Wrike webhook events')
+    parser.add_argument('url')
+    parser.add_argument('task_ids', nargs='+')
+    parser.add_argument('--event', default='TaskStatusChanged')
+    parser.add_argument('--secret', required=True)
+    args = parser.parse_args()
+    r = send(args.url, args.task_ids, args.event, args.secret)
+    print r.status_code, r.text
@@ -1,11 +1,25 @@
+import binascii
+import hashlib
+import hmac
+import json
 import logging
 import os
+import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from email.utils import mktime_tz, parsedate_tz
+from multiprocessing.pool import ThreadPool
 
+import gspread
 import requests
 
+import cache
 import google
+import jobs
+import metrics
+import retries
 
 my_env = os.getenv('my_env')
 
@@ -15,28 +29,65 @@ client_id = os.environ.get('wrike_client_id')
 client_secret = os.environ.get('wrike_client_secret')
 
 pjm_folder = 'IEAAYQ33I4CX7X5T'
+inbound_folder_id = 'IEAAYQ33I4CVHLZI'  # new assessment requests
+
+id_batch_size = 100  # most multi-id calls accept up to 100 comma separated ids
+fetch_workers = int(os.environ.get('wrike_fetch_workers', 4))
+pool_size = int(os.environ.get('wrike_pool_size', 10))  # keep above fetch_workers, the tracker thread shares the pool
+rate_limit = float(os.environ.get('wrike_rate_limit', 80))  # calls per second, shared by every thread
+rate_burst = float(os.environ.get('wrike_rate_burst', 20))
+cache_dir = os.environ.get('wrike_cache_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+webhook_url = os.environ.get('wrike_webhook_url')  # public url of /wrike/webhook, enables event driven tracking
+webhook_secret = os.environ.get('wrike_webhook_secret')
+poll_min_interval = float(os.environ.get('wrike_poll_min', 5))  # bounds of the adaptive poll interval, in seconds
+poll_max_interval = float(os.environ.get('wrike_poll_max', 60))
+reconcile_interval = int(os.environ.get('wrike_reconcile_interval', 600))
+timelog_call = '/accounts/IEAAYQ33/timelogs'
+timelog_chunk_size = int(os.environ.get('wrike_timelog_chunk', 2000))  # timelogs enriched and uploaded at a time
+timelog_columns = ['date', 'user', 'opp_id', 'super_task', 'task', 'hours', 'comment', 'url']  # of a timelog row
+archive_folder_ids = ['IEAAYQ33I4CVHNJC', 'IEAAYQ33I4CVHQOZ']  # left out of the project status, with their subfolders
+metadata_ttls = {'/tasks': 6 * 3600,  # seconds an entity of each kind is served from the metadata cache
+                 '/contacts': 24 * 3600,
+                 'folders': 24 * 3600}
 
 
 def wrike_to_google(date):
-    return str(datetime.fromtimestamp(time.mktime(time.strptime(date[:19], "%Y-%m-%dT%H:%M:%S"))) + timedelta(hours=9))
+    return str(wrike_to_datetime(date))
 
 
 def wrike_to_datetime(date):
-    return datetime.fromtimestamp(time.mktime(time.strptime(date[:19], "%Y-%m-%dT%H:%M:%S"))) + timedelta(hours=9)
+    """ '2016-03-01T10:00:00Z' -> datetime(2016, 3, 1, 19, 0), the fixed format is sliced instead of going through strptime """
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(date[11:13]), int(date[14:16]), int(date[17:19])) + timedelta(hours=9)
+
+
+def wrike_dates_to_google(dates):
+    """
+    wrike_to_google for many dates at once. Timelogs often share their hour, so the shifted 'YYYY-MM-DD HH:' prefix is
+    computed once per hour and only the minutes and seconds are copied from each date.
+    """
+    prefixes = {}
+    output = []
+    for date in dates:
+        prefix = prefixes.get(date[:13])
+        if prefix is None:
+            prefix = prefixes[date[:13]] = str(wrike_to_datetime(date[:13] + ':00:00'))[:14]
+        output.append(prefix + str(date[14:19]))  # dates are ascii, a str takes a quarter of the memory of a unicode
+    return output
 
 
 class NewCreds(object):
+    """
+    One user's Wrike tokens. The access token is only refreshed when it is within refresh_margin seconds of the
+    expires_in Wrike gave with it; threads that need a refresh at the same time wait for the first one and share its token.
+    """
     access_token = ''
     refresh_token = ''
     token_type = ''
     expire_date = datetime.now()
-
-    rate_limit_track = 0
-    last_api_call = datetime.now()
-    time_diffs = []
+    refresh_margin = 300
 
     def __init__(self):
-        pass
+        self.lock = threading.Lock()
 
     def init(self, (new_token, new_renew, token_type)):
         self.access_token = new_token
@@ -44,6 +95,11 @@ class NewCreds(object):
         self.token_type = token_type
         self.expire_date = datetime.now() + timedelta(seconds=3600)
 
+    def _set_tokens(self, r):
+        token = r.json()
+        self.access_token, self.refresh_token, self.token_type = token['access_token'], token['refresh_token'], token['token_type']
+        self.expire_date = datetime.now() + timedelta(seconds=token.get('expires_in', 3600))
+
     def new_auth(self, auth_code):
         """ example response:
             {
@@ -53,182 +109,779 @@ class NewCreds(object):
                 u'expires_in': 3600,
             }
         """
-        r = requests.post('https://www.wrike.com/oauth2/token',
-                          data={'client_id': client_id,
-                                'client_secret': client_secret,
-                                'grant_type': 'authorization_code',
-                                'code': auth_code})
-        self.rate_limiter()
+        r = client.post_token({'client_id': client_id,
+                               'client_secret': client_secret,
+                               'grant_type': 'authorization_code',
+                               'code': auth_code})
         if r.status_code != 200:
             return False
         else:
-            self.access_token, self.refresh_token, self.token_type = r.json()['access_token'], r.json()['refresh_token'], r.json()['token_type']
+            with self.lock:
+                self._set_tokens(r)
+            return True
+
+    def is_fresh(self):
+        return bool(self.access_token) and self.expire_date - datetime.now() > timedelta(seconds=self.refresh_margin)
+
+    def ensure_fresh(self):
+        """ refresh the access token only if it is missing or about to expire, returns False when that fails """
+        if self.is_fresh():
             return True
+        with self.lock:
+            return self.is_fresh() or self._refresh()
+
+    def refresh(self, stale_token=None):
+        """
+        :param stale_token: the access token a call was rejected with; if another thread has replaced it already,
+            its token is used instead of refreshing again
+        """
+        with self.lock:
+            if stale_token is not None and self.access_token != stale_token and self.is_fresh():
+                return True
+            return self._refresh()
 
-    def refresh(self):
-        r = requests.post('https://www.wrike.com/oauth2/token', data={'client_id': client_id,
-                                                                      'client_secret': client_secret,
-                                                                      'grant_type': 'refresh_token',
-                                                                      'refresh_token': self.refresh_token})
-        self.rate_limiter()
+    def _refresh(self):
+        if not self.refresh_token:
+            return False
+        r = client.post_token({'client_id': client_id,
+                               'client_secret': client_secret,
+                               'grant_type': 'refresh_token',
+                               'refresh_token': self.refresh_token})
         if r.status_code != 200:
             return False
         else:
-            self.access_token, self.refresh_token, self.token_type = r.json()['access_token'], r.json()['refresh_token'], r.json()['token_type']
-            self.expire_date = datetime.now() + timedelta(seconds=3600)  # should change this to the json field
+            self._set_tokens(r)
             return True
 
-    def rate_limiter(self):
-        new_time = datetime.now()
-        self.time_diffs.append((new_time - self.last_api_call).microseconds / 1000000.0)
-        self.last_api_call = new_time
 
-        if len(self.time_diffs) > 100:
-            self.time_diffs = self.time_diffs[-100:]
+class CredentialStore(object):
+    """
+    NewCreds per browser session, so users do not overwrite each other's tokens. Sessions are identified by a random
+    id kept in a cookie; past max_sessions the least recently used ones are forgotten.
+    """
 
-        self.rate_limit_track = len(self.time_diffs) / (sum(self.time_diffs) if sum(self.time_diffs) is not 0 else 0.00001)
-        if self.rate_limit_track > 10:
-            print 'rate @', '%.2f' % self.rate_limit_track
-        if self.rate_limit_track > 80:
-            print 'sleeping'
-            time.sleep(1)
-        return self.rate_limit_track
+    def __init__(self, max_sessions=1000):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # {session id: NewCreds}, least recently used first
+        self.lock = threading.Lock()
 
+    def get(self, session_id):
+        with self.lock:
+            credentials = self.sessions.pop(session_id, None) if session_id else None
+            if credentials is not None:
+                self.sessions[session_id] = credentials
+            return credentials
 
-def get_data(call, params=None):
-    no_success = True
-    tries = 3
+    def create(self):
+        """ :return: (session id, NewCreds) of a new session """
+        session_id = binascii.hexlify(os.urandom(16))
+        credentials = NewCreds()
+        with self.lock:
+            self.sessions[session_id] = credentials
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session_id, credentials
+
+    def latest(self):
+        """ the most recently used credentials that still have a token, for work no user asked for (webhooks) """
+        with self.lock:
+            for credentials in reversed(self.sessions.values()):
+                if credentials.access_token:
+                    return credentials
+        return None
+
+
+_active = threading.local()
+
+
+def current_creds():
+    """ the credentials calls on this thread are made with: those set by `using`, or the client's default """
+    return getattr(_active, 'creds', None) or client.auth.credentials
+
+
+def using(credentials, fn):
+    """ wrap fn so that the Wrike calls it makes, on whatever thread it runs, use `credentials` """
+    def run(*args, **kwargs):
+        previous = getattr(_active, 'creds', None)
+        _active.creds = credentials
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _active.creds = previous
+    return run
+
+
+def iter_using(credentials, iterable):
+    """ like using, for a generator: each item is produced with `credentials` active, on whatever thread asks for it """
+    iterator = iter(iterable)
+    next_item = using(credentials, next)
+    while True:
+        try:
+            item = next_item(iterator)
+        except StopIteration:
+            return
+        yield item
+
+
+wrike_requests = metrics.counter('wrike_requests_total', 'Wrike API calls by endpoint and response status.', ['method', 'endpoint', 'status'])
+wrike_request_seconds = metrics.histogram('wrike_request_seconds', 'Latency of each Wrike API call.', ['endpoint'])
+wrike_fetch_seconds = metrics.histogram('wrike_get_data_seconds', 'Time get_data took to return every page of a call.', ['endpoint'])
+wrike_records = metrics.counter('wrike_records_total', 'Records returned by get_data and iter_data.', ['endpoint'])
+rate_limit_wait = metrics.counter('wrike_rate_limit_wait_seconds_total', 'Time spent waiting for a token from the rate limiter.')
+throttle_wait = metrics.counter('wrike_throttle_seconds_total', 'Retry-After time asked for by Wrike with a 429.')
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: every call takes a token before it is sent, tokens refill at `rate` per second up to `capacity`.
+    A 429 from Wrike empties the bucket and holds every thread back until the Retry-After time has passed.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """ blocks until a token is available, returns the seconds spent waiting """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            rate_limit_wait.inc(waited)
+        return waited
+
+    def throttle(self, seconds):
+        """ called when Wrike answers 429, nobody gets a token for `seconds` """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+            self.tokens = 0.0
+
+    def budget(self):
+        """ current state of the bucket, e.g. {'tokens': 12.5, 'rate': 80.0, 'capacity': 20.0, 'blocked_for': 0} """
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            return {'tokens': self.tokens,
+                    'rate': self.rate,
+                    'capacity': self.capacity,
+                    'blocked_for': max(0.0, self.blocked_until - now)}
+
+
+def retry_after(r, default=1.0):
+    """ seconds to wait from a Retry-After header, which is either a number of seconds or an http date """
+    value = r.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        return max(0.0, mktime_tz(date) - time.time()) if date else default
+
+
+class WrikeError(Exception):
+    """ a call that Wrike answered with an error status, e.g. after its retries ran out """
+
+    def __init__(self, message, status=None, retry_after=None):
+        super(WrikeError, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def classify_wrike_error(error):
+    """ throttling, server errors and network errors are worth retrying, other errors would fail the same way again """
+    if isinstance(error, WrikeError):
+        return 'retry' if error.status in (408, 429) or error.status >= 500 else 'fatal'
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return 'retry'
+    return 'fatal'
+
+
+def classify_wrike_post_error(error):
+    """
+    A POST may have been processed even though it failed (a token exchange, a webhook created), and sending it again
+    would do it twice. So it is only retried when it surely was not: the connection could not be made, or Wrike asked
+    to come back later (429, or 503 with a Retry-After).
+    """
+    if isinstance(error, WrikeError):
+        return 'retry' if error.status == 429 or (error.status == 503 and error.retry_after is not None) else 'fatal'
+    if isinstance(error, requests.ConnectTimeout):
+        return 'retry'
+    if isinstance(error, requests.ConnectionError):
+        reason = getattr(error.args[0] if error.args else None, 'reason', None)  # requests wraps urllib3's MaxRetryError
+        if isinstance(reason, requests.packages.urllib3.exceptions.NewConnectionError):  # e.g. connection refused
+            return 'retry'
+    return 'fatal'
+
+
+wrike_policy = retries.Policy('wrike', attempts=int(os.environ.get('wrike_retry_attempts', 6)), base=0.5, cap=20.0,
+                              deadline=float(os.environ.get('wrike_retry_deadline', 120)), classify=classify_wrike_error)
+wrike_post_policy = retries.Policy('wrike', attempts=wrike_policy.attempts, base=wrike_policy.base, cap=wrike_policy.cap,
+                                   deadline=wrike_policy.deadline, classify=classify_wrike_post_error)
+
+
+class WrikeAuth(requests.auth.AuthBase):
+    """
+    adds the current access token at send time, so a token refresh is picked up by every thread;
+    the token is the one of the credentials active on the thread (see `using`), or else of `credentials`
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def __call__(self, r):
+        credentials = getattr(_active, 'creds', None) or self.credentials
+        r.headers['Authorization'] = credentials.token_type + ' ' + credentials.access_token
+        return r
+
+
+class WrikeClient(object):
+    """
+    Owns one keep-alive requests.Session with a connection pool to www.wrike.com, so calls reuse TCP/TLS connections.
+    The session is shared by the report threads and the tracker thread; only the connection pool is mutated concurrently,
+    and the auth header is built per request from the credentials.
+    """
     base_url = 'https://www.wrike.com/api/v3'
-    while no_success and tries != 0:
-        headers = {'Authorization': creds.token_type + ' ' + creds.access_token}
-        r = requests.get(base_url + call, headers=headers, params=params)
-        creds.rate_limiter()
-        # print r.url
-        if r.status_code != 200:
-            print 'error, response: ', r.status_code
-            print r.json()
-        else:
-            no_success = False  # means succeeded
-        if r.status_code == 401:
-            if not creds.refresh():
-                return False
-        tries -= 1
+    token_url = 'https://www.wrike.com/oauth2/token'
+
+    timeout = (10, 120)  # seconds to connect, and between bytes of the response
+
+    def __init__(self, credentials, limiter, pool_size=10):
+        self.auth = WrikeAuth(credentials)
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'Connection': 'keep-alive'})
+
+    def _send(self, method, url, **kwargs):
+        """
+        Takes a rate limit token before every attempt. For a GET throttling (429), server errors and network errors
+        are retried by wrike_policy, a POST is only retried when it was surely not processed (wrike_post_policy).
+        A 429 waits for its Retry-After and holds back every other thread too. Any other response is returned,
+        raises WrikeError when the retries run out.
+        """
+        call = metrics.endpoint(url[len(self.base_url):] if url.startswith(self.base_url) else '/oauth2/token')
+        kwargs.setdefault('timeout', self.timeout)
+
+        def attempt():
+            self.limiter.acquire()
+            with wrike_request_seconds.time(endpoint=call):
+                r = self.session.request(method, url, **kwargs)
+            wrike_requests.inc(method=method, endpoint=call, status=r.status_code)
+            if r.status_code in (408, 429) or r.status_code >= 500:
+                raise WrikeError('{} {} {}'.format(r.status_code, method, call), status=r.status_code,
+                                 retry_after=retry_after(r) if r.status_code == 429 or r.headers.get('Retry-After') else None)
+            return r
+
+        def on_retry(error, delay):
+            if getattr(error, 'status', None) == 429:
+                throttle_wait.inc(delay)
+                self.limiter.throttle(delay)
+
+        policy = wrike_policy if method == 'GET' else wrike_post_policy
+        return policy.call(attempt, on_retry=on_retry, operation='wrike ' + call)
+
+    def get(self, call, params=None):
+        return self._send('GET', self.base_url + call, params=params, auth=self.auth)
+
+    def post(self, call, data=None):
+        return self._send('POST', self.base_url + call, data=data, auth=self.auth)
+
+    def post_token(self, data):
+        return self._send('POST', self.token_url, data=data)
+
+
+def get_page(call, params=None):
+    """
+    one response of a call, with 'data' and, for paginated collections, 'nextPageToken'.
+    Raises WrikeError for any error, the client has already retried the transient ones; a 401 when the access token
+    is rejected and cannot be refreshed, so callers never mistake it for a call without data.
+    """
+    credentials = current_creds()
+    token = credentials.access_token
+    r = client.get(call, params=params)
+    if r.status_code == 401:
+        if not credentials.refresh(stale_token=token):
+            raise WrikeError('401 GET {}, the access token was rejected and could not be refreshed'.format(call), status=401)
+        r = client.get(call, params=params)
+    if r.status_code != 200:
+        print 'error, response: ', r.status_code
+        print r.text[:500]
+        raise WrikeError('{} GET {}'.format(r.status_code, call), status=r.status_code)
+    return r.json()
+
+
+def post_data(call, data=None):
+    token = current_creds().access_token
+    r = client.post(call, data=data)
+    if r.status_code == 401 and current_creds().refresh(stale_token=token):
+        r = client.post(call, data=data)
+    if r.status_code != 200:
+        print 'error, response: ', r.status_code
+        print r.json()
+        return False
     return r.json()['data']
 
 
-creds = NewCreds()
+def iter_data(call, params=None, page_size=None):
+    """
+    Yield the records of a call one by one, requesting the next page only when the previous one has been consumed.
+    :param page_size: sent as pageSize, only for calls that accept it (task queries)
+    """
+    params = dict(params or {})
+    if page_size:
+        params['pageSize'] = page_size
+    while True:
+        page = get_page(call, params=params)
+        wrike_records.inc(len(page['data']), endpoint=metrics.endpoint(call))
+        for record in page['data']:
+            yield record
+        if not page.get('nextPageToken'):
+            return
+        params['nextPageToken'] = page['nextPageToken']
 
 
-def get_timelog_table():
+def get_data(call, params=None):
+    with wrike_fetch_seconds.time(endpoint=metrics.endpoint(call)):
+        page = get_page(call, params=params)
+        wrike_records.inc(len(page['data']), endpoint=metrics.endpoint(call))
+        if not page.get('nextPageToken'):
+            return page['data']
+        return page['data'] + list(iter_data(call, dict(params or {}, nextPageToken=page['nextPageToken'])))
+
+
+creds = NewCreds()  # used by threads with no user's credentials active
+credential_store = CredentialStore()
+limiter = TokenBucket(rate_limit, rate_burst)
+client = WrikeClient(creds, limiter, pool_size=pool_size)
+metrics.gauge('wrike_rate_limit_tokens', 'Tokens left in the rate limiter bucket.', lambda: client.limiter.budget()['tokens'])
+metrics.gauge('wrike_rate_limit_blocked_seconds', 'Seconds until the rate limiter hands out tokens again after a 429.',
+              lambda: client.limiter.budget()['blocked_for'])
+
+
+def get_data_by_ids(call, ids, params=None):
     """
-    First, make unique lists to iterate through (to save on API calls) then iterate though the unique lists, and attach them to "timelogs" json/dictionary
-    :return:
+    Fetch many entities with as few calls as possible: ids are deduplicated, split into chunks of id_batch_size
+    and each chunk is requested as call/<id>,<id>,... on a small thread pool.
+    :param call: the collection to fetch from, e.g. '/tasks'
+    :param ids: iterable of ids, may contain duplicates
+    :return: {id: entity}
     """
+    unique_ids = []
+    seen = set()
+    for entity_id in ids:
+        if entity_id and entity_id not in seen:
+            seen.add(entity_id)
+            unique_ids.append(entity_id)
+    chunks = [unique_ids[i:i + id_batch_size] for i in range(0, len(unique_ids), id_batch_size)]
 
-    timelogs = get_data('/accounts/IEAAYQ33/timelogs')
-    print '# timelogs:', len(timelogs)
-    task_list = []
-    user_list = []
+    def fetch(chunk):
+        return get_data(call + '/' + ','.join(map(str, chunk)), params=params)
 
-    for log in timelogs:
-        task_list.append(log['taskId'])
-        user_list.append(log['userId'])
+    if len(chunks) > 1:
+        pool = ThreadPool(min(fetch_workers, len(chunks)))
+        try:
+            results = pool.map(using(current_creds(), fetch), chunks)  # the pool's threads call with this thread's credentials
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(fetch, chunks)
 
-    unique_tasks = list(set(task_list))
-    unique_users = list(set(user_list))
+    entities = {}
+    for result in results:
+        for entity in result:
+            entities[entity['id']] = entity
+    return entities
 
-    unique_tasks_csv = ','.join(map(str, unique_tasks))
-    task_details = get_data('/tasks/' + unique_tasks_csv)  # todo need to batch if its over 100 tasks
 
-    super_task_dictionary = []  # create a dictionary of super task details
-    task_details_copy = task_details
-    for task in task_details_copy:
-        dictionary_payload = {}
-        if 'superTaskIds' in task and len(task['superTaskIds']) > 0:  # add custom id from parent task
-            super_task_id = str(task['superTaskIds'][0])  # for readability
+metadata_cache = cache.MetadataCache(os.path.join(cache_dir, 'metadata.sqlite'), ttls=metadata_ttls,
+                                     max_entries=int(os.environ.get('wrike_cache_size', 50000)))
 
-            if super_task_dictionary and next((super_task for super_task in super_task_dictionary if super_task['id'] == super_task_id), None):
-                # if this super task id is already in the dictionary, just skip
-                continue
 
-            super_task_details = get_data('/tasks/' + super_task_id)[0]
-            task_details.append(super_task_details)
+def get_cached_by_ids(call, ids, fresh=False):
+    """
+    get_data_by_ids through the metadata cache: only ids that are missing or expired are fetched
+    :param fresh: skip the cache lookup, but still store what was fetched
+    """
+    ids = set(ids)
+    entities = {} if fresh else metadata_cache.get_many(call, ids)
+    fetched = get_data_by_ids(call, ids.difference(entities))
+    metadata_cache.put_many(call, fetched)
+    entities.update(fetched)
+    return entities
 
-            if 'customFields' in super_task_details and len(super_task_details['customFields']) > 0:
-                if super_task_details['customFields'][0]['id'] == 'IEAAYQ33JUAACWWV':
-                    dictionary_payload['opp_id'] = super_task_details['customFields'][0]['value']
 
-            if 'opp_id' not in dictionary_payload:
-                dictionary_payload['opp_id'] = ''
-            dictionary_payload['super_task_title'] = super_task_details['title']
-            dictionary_payload['id'] = super_task_details['id']
-            super_task_dictionary.append(dictionary_payload)
+def get_tasks(task_ids, fresh=False):
+    return get_cached_by_ids('/tasks', task_ids, fresh=fresh)
 
-    user_dictionary = []  # create a dictionary of user data (first name for now)
-    for user in unique_users:
-        user_details = get_data('/users/' + user)
-        user_dictionary.append({'id': user, 'user_name': user_details[0]['firstName']})
-
-    for log in timelogs:  # for each log, add the task data, then user data (first name)
-        for task in task_details:
-            if log['taskId'] == task['id']:
-                log['task_title'] = task['title']
-                log['super_task_title'] = ''
-                task_opp_id = ''
-                if 'customFields' in task and len(task['customFields']) > 0:  # add custom id from task if it exists
-                    if task['customFields'][0]['id'] == 'IEAAYQ33JUAACWWV':
-                        task_opp_id = task['customFields'][0]['value']
-
-                # if there is a super task id in the task, fetch the details from the dictionary
-                if 'superTaskIds' in task and len(task['superTaskIds']) > 0:
-                    super_task_id = str(task['superTaskIds'][0])  # for readability
-
-                    def get_parent_id(child_id):
-                        # we know its a super task, but first we want to know if this super task has a super task
-                        working_id = child_id
-                        parent_id = next((item['superTaskIds'][0] for item in task_details if
-                                          item['id'] == working_id and 'superTaskIds' in task and len(item['superTaskIds']) > 0), None)
-
-                        if parent_id:
-                            return get_parent_id(parent_id)
-                        else:
-                            return working_id
-
-                    super_task_parent_id = get_parent_id(super_task_id)
-                    super_task_simple_json = next((item for item in super_task_dictionary if item['id'] == super_task_parent_id), None)
-                    if super_task_simple_json:
-                        log['super_task_title'], task_opp_id = super_task_simple_json['super_task_title'], super_task_simple_json['opp_id']
-                else:
-                    log['super_task_title'] = task['title']
-                log['task_opp_id'] = task_opp_id
-                log['task_url'] = task['permalink']
-
-        # add the user name
-        user = next((item for item in user_dictionary if item['id'] == log['userId']), None)
-        log['user_name'] = user['user_name']
 
-    output = []
-    for log in timelogs:  # log
-        output.append(
-            [wrike_to_google(log['createdDate']), log['user_name'],
-             log['task_opp_id'], log['super_task_title'], log['task_title'], '%.2f' % log['hours'], log['comment'], log['task_url']])
+def get_users(user_ids):
+    # /users only takes a single id, /contacts returns the same fields for up to 100 ids
+    return get_cached_by_ids('/contacts', user_ids)
+
+
+def get_opp_id(task):
+    """ returns the opportunity id custom field of a task, or '' if it does not have one """
+    if 'customFields' in task and len(task['customFields']) > 0:
+        if task['customFields'][0]['id'] == 'IEAAYQ33JUAACWWV':
+            return task['customFields'][0]['value']
+    return ''
 
+
+class SuperTaskResolver(object):
+    """
+    The super task hierarchy of the tasks in a report. Tasks are fetched together with all of their ancestors one level
+    at a time, each level as one batch of id calls, so a tree of any size costs one round of calls per level.
+    The root of every task is memoized, and both are kept for the life of the resolver (one report), so later chunks
+    only fetch the tasks and ancestors they have not seen yet.
+    """
+    fields = ('id', 'title', 'superTaskIds', 'customFields', 'permalink')  # all a report needs from a task
+
+    def __init__(self):
+        self.tasks = {}  # every task fetched so far, by id, with only `fields`
+        self.missing = set()  # ids that could not be fetched, not asked for again
+        self.roots = {}  # {task id: (root id, root title, root opp id)}, None when the root could not be fetched
+
+    @staticmethod
+    def super_task_id(task):
+        if 'superTaskIds' in task and len(task['superTaskIds']) > 0:
+            return str(task['superTaskIds'][0])
+        return None
+
+    def add(self, tasks):
+        """ add tasks fetched some other way, e.g. by an account wide task query """
+        for task in tasks:
+            self.tasks[task['id']] = dict((field, task[field]) for field in self.fields if field in task)
+
+    def fetch(self, task_ids):
+        """ make sure task_ids and all of their ancestors are known, one batched call per level of the tree """
+        level = set(task_ids).difference(self.tasks, self.missing)
+        while level:
+            fetched = get_tasks(level)
+            self.add(fetched.values())
+            self.missing.update(level.difference(fetched))
+            level = set(self.super_task_id(task) for task in fetched.values()).difference(self.tasks, self.missing, [None])
+
+    def get(self, task_id):
+        return self.tasks.get(task_id)
+
+    def root(self, task_id):
+        """
+        (id, title, opp id) of the task at the top of task_id's chain of super tasks, task_id itself when it has no
+        super task, or None when the top could not be fetched. A chain that loops stops at the task before the loop.
+        """
+        chain = []
+        working_id = task_id
+        while working_id not in self.roots:
+            chain.append(working_id)
+            task = self.tasks.get(working_id)
+            if task is None:
+                self.roots[working_id] = None
+                break
+            parent_id = self.super_task_id(task)
+            if parent_id is None or parent_id in chain:
+                self.roots[working_id] = (task['id'], task['title'], get_opp_id(task))
+                break
+            working_id = parent_id
+        for chain_id in chain:
+            self.roots[chain_id] = self.roots[working_id]
+        return self.roots[task_id]
+
+
+def join_timelogs(timelogs, resolver, user_dictionary, strings=None):
+    """
+    Build the sheet row of each timelog in a single pass, without adding anything to the timelog json.
+    The columns that come from a task are resolved only once per task.
+    :param timelogs: list of timelog json
+    :param resolver: SuperTaskResolver that has fetched the tasks of the timelogs
+    :param user_dictionary: {user id: {'id', 'user_name'}}
+    :param strings: {string: string} shared by every chunk of a table, so each distinct name, title, url and hours
+        value is stored once however many rows use it
+    :return: one tuple per timelog: date, user name, opp id, super task title, task title, hours, comment, task url
+    """
+    strings = {} if strings is None else strings
+
+    def task_columns(task_id):
+        """ (opp id, super task title, task title, url) of a task, with its root super task's title and opp id if it has one """
+        task = resolver.get(task_id)
+        if not task:
+            return '', '', '', ''
+        super_task_title = ''
+        task_opp_id = get_opp_id(task)
+
+        # if there is a super task id in the task, take the title and opp id of the top of its chain
+        super_task_id = resolver.super_task_id(task)
+        if super_task_id:
+            root = resolver.root(super_task_id)
+            if root:
+                super_task_title, task_opp_id = root[1], root[2]
+        else:
+            super_task_title = task['title']
+        return tuple(strings.setdefault(value, value) for value in (task_opp_id, super_task_title, task['title'], task['permalink']))
+
+    user_names = dict((user_id, strings.setdefault(user['user_name'], user['user_name'])) for user_id, user in user_dictionary.items())
+    columns_by_task = {}
+    rows = []
+    for log, date in zip(timelogs, wrike_dates_to_google(log['createdDate'] for log in timelogs)):
+        columns = columns_by_task.get(log['taskId'])
+        if columns is None:
+            columns = columns_by_task[log['taskId']] = task_columns(log['taskId'])
+        hours = '%.2f' % log['hours']
+        rows.append((date, user_names[log['userId']], columns[0], columns[1], columns[2],
+                     strings.setdefault(hours, hours), log['comment'], columns[3]))
+    return rows
+
+
+def iter_timelog_chunks(params=None, chunk_size=None):
+    """
+    Stream the account's timelogs through the enrichment in chunks, so only one chunk of records is in memory.
+    :return: generator of (timelogs, rows) with one row per timelog
+    """
+    chunk_size = chunk_size or timelog_chunk_size
+    chunk = []
+    count = 0
+    strings = {}  # shared by the chunks, see join_timelogs
+    resolver = SuperTaskResolver()  # so is the task tree, each chunk only fetches the tasks it adds to it
+    for log in iter_data(timelog_call, params=params):
+        chunk.append(log)
+        if len(chunk) >= chunk_size:
+            count += len(chunk)
+            yield chunk, build_timelog_rows(chunk, strings, resolver)
+            chunk = []
+    if chunk:
+        count += len(chunk)
+        yield chunk, build_timelog_rows(chunk, strings, resolver)
+    print '# timelogs:', count
+
+
+def get_timelog_table():
+    output = []
+    for timelogs, rows in iter_timelog_chunks():
+        output.extend(rows)
     return output
 
 
+def build_timelog_rows(timelogs, strings=None, resolver=None):
+    """
+    First, make unique lists to iterate through (to save on API calls) then fetch the tasks with their super tasks and the users, and join them to "timelogs" json/dictionary
+    :return: one sheet row (a tuple, see join_timelogs) per timelog, in the same order
+    """
+    resolver = resolver or SuperTaskResolver()
+    unique_tasks = set(log['taskId'] for log in timelogs)
+    unique_users = set(log['userId'] for log in timelogs)
+
+    resolver.fetch(unique_tasks)
+
+    user_details = get_users(unique_users)
+    user_dictionary = {}  # create a dictionary of user data (first name for now)
+    for user in unique_users:
+        user_dictionary[user] = {'id': user, 'user_name': user_details[user]['firstName']}
+
+    return join_timelogs(timelogs, resolver, user_dictionary, strings)
+
+
+class TimelogSync(object):
+    """
+    Keeps a local snapshot of the timelog sheet, so a run only fetches the timelogs updated since the last one (the watermark)
+    and only rewrites their rows. Timelogs keep the sheet row they were first written to, new ones are appended.
+    Wrike does not list deleted timelogs, so deletions are picked up by a full resync every full_sync_interval.
+
+    The snapshot is a SQLite file with one row per sheet row, so neither kind of sync holds the whole table in memory:
+        rows: position (0 based sheet row), id (timelog id), data (json row)
+        meta: watermark ('2016-03-01T10:00:00Z'), full_sync (epoch of the last full sync)
+    """
+
+    def __init__(self, path, full_sync_interval=24 * 3600):
+        self.path = path
+        self.full_sync_interval = full_sync_interval
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE IF NOT EXISTS rows (position INTEGER PRIMARY KEY, id TEXT UNIQUE, data TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        return connection
+
+    def reset(self):
+        with self.lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+    @staticmethod
+    def _watermark(timelogs, previous=''):
+        return max([previous] + [log.get('updatedDate') or log['createdDate'] for log in timelogs])
+
+    def sync(self, sheets, start_row=1):
+        """
+        Bring the open worksheet of `sheets` up to date, starting at start_row.
+        :return: the number of rows written
+        """
+        with self.lock:
+            connection = self._connect()
+            try:
+                meta = dict(connection.execute('SELECT key, value FROM meta').fetchall())
+                if not meta.get('watermark') or time.time() - float(meta.get('full_sync', 0)) > self.full_sync_interval:
+                    return self._full_sync(connection, sheets, start_row)
+                return self._incremental_sync(connection, sheets, start_row, meta['watermark'])
+            finally:
+                connection.close()
+
+    def _incremental_sync(self, connection, sheets, start_row, watermark):
+        next_position = connection.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM rows').fetchone()[0]
+        written = 0
+        new_watermark = watermark
+        phases = metrics.PhaseTimer('timelog_sync')
+        for timelogs, rows in phases.iterate('fetch_and_enrich', iter_timelog_chunks(params={'updatedDate': json.dumps({'start': watermark})})):
+            changed_rows = {}  # {position in the sheet: row}
+            with phases('snapshot'):
+                for log, row in zip(timelogs, rows):
+                    known = connection.execute('SELECT position, data FROM rows WHERE id = ?', (log['id'],)).fetchone()
+                    if known is None:
+                        changed_rows[next_position] = row
+                        connection.execute('INSERT INTO rows (position, id, data) VALUES (?, ?, ?)', (next_position, log['id'], json.dumps(row)))
+                        next_position += 1
+                    elif json.loads(known[1]) != list(row):
+                        changed_rows[known[0]] = row
+                        connection.execute('UPDATE rows SET data = ? WHERE position = ?', (json.dumps(row), known[0]))
+            with phases('sheets'):
+                sheets.write_rows(changed_rows, start_row=start_row)  # batched reads and writes however scattered the rows are
+            written += len(changed_rows)
+            jobs.progress('{} updated rows written'.format(written))
+            new_watermark = self._watermark(timelogs, new_watermark)
+
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('watermark', new_watermark))
+        connection.commit()
+        print phases.summary()
+        return written
+
+    def _full_sync(self, connection, sheets, start_row):
+        known_rows = connection.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+        connection.execute('DELETE FROM rows')
+        position = 0
+        watermark = ''
+        phases = metrics.PhaseTimer('timelog_full_sync')
+        for timelogs, rows in phases.iterate('fetch_and_enrich', iter_timelog_chunks()):
+            with phases('sheets'):  # only cells that differ from the sheet are sent, it is never emptied
+                sheets.sync_table(rows, start_row=start_row + position, trim=False)
+            with phases('snapshot'):
+                connection.executemany('INSERT INTO rows (position, id, data) VALUES (?, ?, ?)',
+                                       [(position + i, log['id'], json.dumps(row)) for i, (log, row) in enumerate(zip(timelogs, rows))])
+            position += len(rows)
+            watermark = self._watermark(timelogs, watermark)
+            jobs.progress('{} rows synced'.format(position))
+        if position == 0 and known_rows:
+            # an account does not lose every timelog at once, keep the sheet, the snapshot and the watermark as they are
+            connection.rollback()
+            print 'full sync got no timelogs, {} rows on the sheet are kept'.format(known_rows)
+            return 0
+        with phases('sheets'):
+            sheets.trim_rows(start_row - 1 + position)
+
+        meta = [('full_sync', str(time.time()))]
+        if watermark:  # an empty one would make the next run ask for every timelog updated since ''
+            meta.append(('watermark', watermark))
+        connection.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', meta)
+        connection.commit()
+        print phases.summary()
+        return position
+
+
+timelog_sync = TimelogSync(os.path.join(cache_dir, 'timelog_snapshot.sqlite'),
+                           full_sync_interval=int(os.environ.get('wrike_full_sync_interval', 24 * 3600)))
+
+
+def get_folders():
+    """ the account's folders (not projects), cached like the other metadata """
+    folder_list = metadata_cache.get('folders', 'IEAAYQ33')
+    if folder_list is None:
+        folder_list = get_data('/accounts/IEAAYQ33/folders', params={'project': 'false'})
+        metadata_cache.put('folders', 'IEAAYQ33', folder_list)
+    return folder_list
+
+
+project_status_header = ['Folder', 'Project', 'Opp ID', 'Tasks', 'Active', 'Completed', 'Overdue', 'Next due', 'Last updated', 'Link']
+
+
 def get_project_details():
-    folder_list = get_data('/accounts/IEAAYQ33/folders', params={'project': 'false'})
-    for folder in folder_list:
-        if folder['id'] != 'IEAAYQ33I4CVHNJC' and folder['id'] != 'IEAAYQ33I4CVHQOZ':  # not archive folders
-            print folder['id'], folder['title']
-            task_list = get_data('/folders/' + folder['id'] + '/tasks', params={'fields': '["superTaskIds"]'})
-            for task in task_list:
-                if 'superTaskIds' in task and len(task['superTaskIds']) > 0:
-                    print task
-                    print task['id'], task['title']
-    # on hold while doing assessment turnaround time
-    # TODO: finish project dashboard
-    pass
+    """
+    Project status: every task of the account, grouped by folder and by the project (root super task) it belongs to.
+    All tasks come from one paginated account wide query, so the hierarchy is resolved in memory without more calls.
+    A task is counted in each folder it is in, subtasks that are in no folder count in their project's folders.
+    Archive folders and their subfolders are left out.
+    :return: the report table, header first, one row per folder and project
+    """
+    folder_list = get_folders()
+    folder_titles = dict((folder['id'], folder['title']) for folder in folder_list)
+    children = dict((folder['id'], folder.get('childIds', [])) for folder in folder_list)
+    archived = set()
+    pending = list(archive_folder_ids)
+    while pending:
+        folder_id = pending.pop()
+        if folder_id not in archived:
+            archived.add(folder_id)
+            pending.extend(children.get(folder_id, []))
+
+    tasks = []
+    for task in iter_data('/accounts/IEAAYQ33/tasks', params={'fields': '["parentIds","superTaskIds","customFields"]', 'subTasks': 'true'},
+                          page_size=1000):
+        tasks.append(task)
+        if len(tasks) % 5000 == 0:
+            jobs.progress('{} tasks read'.format(len(tasks)))
+    resolver = SuperTaskResolver()
+    resolver.add(tasks)
+    task_index = dict((task['id'], task) for task in tasks)
+
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    groups = {}  # {(folder id, project id): {'tasks': n, 'Active': n, ..., 'next_due': date, 'updated': date}}
+    for task in tasks:
+        root = resolver.root(task['id']) or (task['id'], task['title'], get_opp_id(task))
+        folder_ids = task.get('parentIds') or task_index.get(root[0], {}).get('parentIds', [])
+        due = (task.get('dates') or {}).get('due', '')[:10]
+        for folder_id in folder_ids:
+            if folder_id not in folder_titles or folder_id in archived:
+                continue
+            group = groups.setdefault((folder_id, root[0]), {'root': root, 'tasks': 0, 'Active': 0, 'Completed': 0, 'overdue': 0,
+                                                             'next_due': '', 'updated': ''})
+            group['tasks'] += 1
+            group[task.get('status')] = group.get(task.get('status'), 0) + 1
+            if task.get('status') == 'Active' and due:
+                if due < today:
+                    group['overdue'] += 1
+                else:  # the next date coming up, overdue tasks are only counted
+                    group['next_due'] = min(group['next_due'] or due, due)
+            group['updated'] = max(group['updated'], task.get('updatedDate', ''))
+
+    table = [project_status_header]
+    for (folder_id, root_id), group in sorted(groups.items(), key=lambda item: (folder_titles[item[0][0]], item[1]['root'][1])):
+        root_task = task_index.get(root_id, {})
+        table.append([folder_titles[folder_id], group['root'][1], group['root'][2], group['tasks'], group['Active'], group['Completed'],
+                      group['overdue'], group['next_due'], wrike_to_google(group['updated']) if group['updated'] else '',
+                      root_task.get('permalink', '')])
+    print '# tasks:', len(tasks), '# project status rows:', len(table) - 1
+    return table
 
 
 class TrackAssessments(object):
@@ -240,68 +893,90 @@ class TrackAssessments(object):
         self.logging.open_workbook('https://docs.google.com/a/gengo.com/spreadsheets/d/1_rlW7jHDNw-_-czet0WeO834n2alyn--U9lcJIHZSPY/edit?usp=sharing')
         self.pending_requests = None
         self.task_details = None
+        self.known_tasks = {}  # task details fetched this cycle, by id
         self.new_request = False
         self.assessment_provided = False
 
-    def get_requests_from_wrike(self):
-        new_requests = get_data('/folders/IEAAYQ33I4CVHLZI/tasks')
+    def get_requests_from_wrike(self, task_ids=None):
+        """ tasks in the inbound folder, or only those of task_ids that are in it """
+        if task_ids is not None:
+            tasks = get_tasks(task_ids, fresh=True)
+            self.known_tasks.update(tasks)
+            return [task for task in tasks.values() if inbound_folder_id in task.get('parentIds', [])]
+        new_requests = get_data('/folders/' + inbound_folder_id + '/tasks')
         # for task in list(new_requests):
         #     if task['customStatusId'] != 'IEAAYQ33JMAAAAAA':  # don't return requests that have already have a status
         #         new_requests.remove(task)
         return new_requests
 
-    @google.retry
-    def append_new_requests(self):
-        self.new_request = False
-        for task in self.get_requests_from_wrike():
-            if not self.tracking.find(task['id']):
-                self.new_request = True
-                self.tracking.append_row([task['id'], task['title']])  # , wrike_to_google(task['createdDate']), task['title']])
-
-    @google.retry
     def get_pending_requests(self):
-        all_cells = self.tracking.worksheet.col_values(1)
-        for item in list(all_cells):
-            if item == None or item == '':
-                all_cells.remove(item)
-        self.pending_requests = all_cells
-
-    def check_request_status(self):
-        if len(self.pending_requests) == 0:
+        """ read the task ids in column 1 of the tracking sheet, once per cycle """
+        all_cells = self.tracking.col_values(1)
+        self.pending_requests = [item for item in all_cells if item]
+        self.known_tasks = {}
+
+    def append_new_requests(self, task_ids=None):
+        """ add the inbound tasks that are not on the tracking sheet yet, in one range write """
+        tracked = set(self.pending_requests)
+        new_tasks = [task for task in self.get_requests_from_wrike(task_ids) if task['id'] not in tracked]
+        self.new_request = len(new_tasks) > 0
+        if self.new_request:
+            self.tracking.append_rows([[task['id'], task['title']] for task in new_tasks])  # , wrike_to_google(task['createdDate']), task['title']])
+            self.pending_requests.extend(task['id'] for task in new_tasks)
+            self.known_tasks.update((task['id'], task) for task in new_tasks)
+
+    def check_request_status(self, task_ids=None):
+        if task_ids is None:
+            pending = self.pending_requests
+            fetch = pending
+        else:  # only the tasks we were told about, most of them were fetched by get_requests_from_wrike already
+            pending = [task_id for task_id in self.pending_requests if task_id in task_ids]
+            fetch = [task_id for task_id in pending if task_id not in self.known_tasks]
+        if len(pending) == 0:
             self.task_details = []
             return
-        request_csv = ','.join(map(str, self.pending_requests))
-        self.task_details = get_data('/tasks/' + request_csv)  # todo need to batch if its over 100 tasks
+        self.known_tasks.update(get_tasks(fetch, fresh=True))  # the status is what we are checking, never serve it from cache
+        self.task_details = [self.known_tasks[task_id] for task_id in pending if task_id in self.known_tasks]
 
-    @google.retry
     def insert_assessed_request(self):
+        """
+        log the assessed requests on the sheet of the week they were created in, one batched append per week.
+        Each week's requests leave pending_requests as soon as they are logged, so when a later week fails the tracking
+        sheet can still be rewritten without them and they are not logged again by the next cycle.
+        """
         self.assessment_provided = False
-        inbound_folder_id = 'IEAAYQ33I4CVHLZI'
+        rows_by_week = OrderedDict()
+        assessed_by_week = {}
         for task in self.task_details:
             print task
             if inbound_folder_id not in task[
                 'parentIds']:  # task['customStatusId'] != 'IEAAYQ33JMAAAAAA':  # print wrike.get_data('/accounts/IEAAYQ33/workflows')
                 self.assessment_provided = True
                 ctime = wrike_to_datetime(task['createdDate'])
-                self.logging.open_worksheet('Tasks W' + str(ctime.isocalendar()[1]), force=True)
-                self.logging.append_row([wrike_to_google(task['createdDate']), task['title'], datetime.today(), task['permalink']])
-                try:
-                    self.pending_requests.remove(task['id'])
-                except:
-                    pass
-
-    @google.retry
+                sheet_name = 'Tasks W' + str(ctime.isocalendar()[1])
+                rows_by_week.setdefault(sheet_name, []).append(
+                    [wrike_to_google(task['createdDate']), task['title'], datetime.today(), task['permalink']])
+                assessed_by_week.setdefault(sheet_name, set()).add(task['id'])
+
+        for sheet_name, rows in rows_by_week.items():
+            self.logging.open_worksheet(sheet_name, force=True)  # the handle is cached by the google client pool
+            self.logging.append_rows(rows)
+            self.pending_requests = [task_id for task_id in self.pending_requests if task_id not in assessed_by_week[sheet_name]]
+
     def rewrite_tracking_sheet(self):
-        self.tracking.worksheet.resize(1, 1)  # dangerous if lost auth, can use @google.retry
         table_of_pending_requests = []
 
+        missing = [task_id for task_id in self.pending_requests if task_id not in self.known_tasks]
+        self.known_tasks.update(get_tasks(missing))  # normally empty, check_request_status fetched them all
         for task_id in self.pending_requests:
-            task = get_data('/tasks/' + task_id)[0]
-            table_of_pending_requests.append([task_id, task['title']])
+            table_of_pending_requests.append([task_id, self.known_tasks[task_id]['title']])
         # print table_of_pending_requests
-        self.tracking.upload_table(table_of_pending_requests)
+        self.tracking.sync_table(table_of_pending_requests, key_col=1)
 
-    def do(self):
+    def do(self, task_ids=None):
+        """
+        :param task_ids: only look at these tasks (reported by a webhook), None checks the whole inbound folder
+        """
         # get current requests, and created times
         # append them to the bottom if not already in sheet
         # check statuses of all the requests
@@ -309,27 +984,170 @@ class TrackAssessments(object):
         # each time we add to the W## sheet, remove it from pending_requests
         # overwrite pending requests sheet
         # print ''
-        print 'appending new,',
-        self.append_new_requests()
-        print 'get known pending,',
-        self.get_pending_requests()
-        print 'checking status,',
-        self.check_request_status()
-        print 'processing assessed,',
-        self.insert_assessed_request()
-        print 'rewrite pending,',
-        if self.new_request or self.assessment_provided:
-            self.rewrite_tracking_sheet()
-        print 'finished.'
+        phases = metrics.PhaseTimer('tracker')
+        with phases('get_pending'):
+            self.get_pending_requests()
+        with phases('append_new'):
+            self.append_new_requests(task_ids)
+        with phases('check_status'):
+            self.check_request_status(task_ids)
+        try:
+            with phases('insert_assessed'):
+                self.insert_assessed_request()
+        finally:  # even when a week failed, take the weeks that were logged off the tracking sheet
+            with phases('rewrite_pending'):
+                if self.new_request or self.assessment_provided:
+                    self.rewrite_tracking_sheet()
+        print phases.summary()
+
+
+class TaskEvents(object):
+    """ ids of tasks that webhooks reported as changed, waiting for the tracker thread """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.task_ids = set()
+
+    def put(self, task_ids):
+        with self.condition:
+            self.task_ids.update(task_ids)
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        """ block until task ids arrive or timeout seconds pass, then take every id queued so far """
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.task_ids:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            task_ids, self.task_ids = self.task_ids, set()
+        return task_ids
+
+
+assessment_events = TaskEvents()
+webhook_handshake = threading.Event()  # set while register_webhook creates a webhook, Wrike sends X-Hook-Secret then
+
+
+def register_webhook(hook_url, secret):
+    """
+    make sure Wrike posts the inbound folder's task events to hook_url, signed with secret, returns the webhook or False.
+    Without a secret /wrike/webhook refuses every post, so no webhook is registered.
+    """
+    if not secret:
+        print 'not registering a webhook, wrike_webhook_secret is not set'
+        return False
+    for webhook in get_data('/accounts/IEAAYQ33/webhooks'):
+        if webhook.get('hookUrl') == hook_url and webhook.get('status') == 'Active':
+            return webhook
+    webhook_handshake.set()
+    try:
+        webhooks = post_data('/folders/' + inbound_folder_id + '/webhooks', data={'hookUrl': hook_url, 'secret': secret})
+    finally:
+        webhook_handshake.clear()
+    return webhooks[0] if webhooks else False
+
+
+def webhook_signature(value):
+    """ hex HMAC-SHA256 of value with the webhook secret, used both for the X-Hook-Secret handshake and X-Hook-Signature """
+    return hmac.new(webhook_secret, value, hashlib.sha256).hexdigest()
+
+
+def webhook_task_ids(events):
+    """ the task ids of a webhook payload, a list of events like {'taskId': ..., 'eventType': 'TaskStatusChanged', ...} """
+    if isinstance(events, dict):
+        events = [events]
+    return set(event['taskId'] for event in events if event.get('taskId'))
+
+
+class AdaptivePoller(object):
+    """
+    Polling for the tracker when there is no webhook. A poll only asks Wrike for the tasks updated since the previous
+    poll, so the tracker can skip the cycle when none of them matter. The interval doubles after each idle poll up to
+    max_interval and drops back to min_interval as soon as something changed.
+    """
+    overlap = 5  # seconds each poll reaches back before the previous one, for clock skew between us and Wrike
+
+    def __init__(self, min_interval=5, max_interval=60):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.since = datetime.utcnow()
+        self.polls = 0
+        self.idle_polls = 0
+        self.last_change = None
+
+    def changed_tasks(self):
+        """ tasks updated since the previous poll, with their parentIds """
+        started = datetime.utcnow()
+        params = {'updatedDate': json.dumps({'start': (self.since - timedelta(seconds=self.overlap)).strftime('%Y-%m-%dT%H:%M:%SZ')}),
+                  'fields': '["parentIds"]'}
+        tasks = list(iter_data('/accounts/IEAAYQ33/tasks', params=params, page_size=1000))
+        self.since = started
+        return tasks
+
+    def record(self, changed):
+        self.polls += 1
+        if changed:
+            self.interval = self.min_interval
+            self.last_change = time.time()
+        else:
+            self.idle_polls += 1
+            self.interval = min(self.max_interval, self.interval * 2)
+
+    def state(self):
+        return {'min_interval': self.min_interval,
+                'max_interval': self.max_interval,
+                'interval': self.interval,
+                'polls': self.polls,
+                'idle_polls': self.idle_polls,  # cycles that made no Sheets calls and only one Wrike call
+                'last_change': self.last_change}
 
 
 def track_wrike():
+    """
+    With a webhook (wrike_webhook_url), only process the tasks it reports.
+    Without one, poll Wrike for updated tasks at an adaptive interval and only process the ones we track.
+    Either way the whole inbound folder is reconciled every reconcile_interval seconds in case a change was missed.
+    """
     assessment_tracking = TrackAssessments()
+    webhook = False
+    if webhook_url:
+        try:
+            webhook = register_webhook(webhook_url, webhook_secret)
+        except (WrikeError, requests.RequestException) as e:  # e.g. a 403 when the user may not manage webhooks
+            print 'could not register the webhook, polling instead:', repr(e)
+    poller = None if webhook else AdaptivePoller(poll_min_interval, poll_max_interval)
+    print 'tracking assessments', 'from webhook events' if webhook else 'by polling'
+    cycles = 0
+    next_reconcile = 0
+    failed_cycles = 0
     while True:
-        assessment_tracking.do()
-        print 'end of loop. sleeping',
-        for step in list(reversed(range(1, 10))):
-            print step,
-            time.sleep(1)
-        print ''
-    pass
+        timeout = max(0, next_reconcile - time.time())
+        task_ids = assessment_events.wait(min(timeout, poller.interval) if poller else timeout)
+        try:
+            if time.time() >= next_reconcile:
+                assessment_tracking.do()  # also covers any task ids that were queued
+                next_reconcile = time.time() + reconcile_interval
+            else:
+                if poller:
+                    tracked = set(assessment_tracking.pending_requests or [])
+                    task_ids.update(task['id'] for task in poller.changed_tasks()
+                                    if task['id'] in tracked or inbound_folder_id in task.get('parentIds', []))
+                    poller.record(len(task_ids) > 0)
+                if task_ids:
+                    assessment_tracking.do(task_ids)
+        except (WrikeError, retries.RetryableError, gspread.GSpreadException, requests.RequestException) as e:
+            # the retries ran out; keep tracking, and reconcile everything on the next cycle so nothing is missed
+            print 'tracker cycle failed:', repr(e)
+            failed_cycles += 1
+            next_reconcile = 0
+            time.sleep(min(poll_max_interval, poll_min_interval * 2 ** min(failed_cycles, 5)))
+        else:
+            failed_cycles = 0
+        cycles += 1
+        state = {'cycles': cycles, 'failed_cycles': failed_cycles, 'pending_requests': len(assessment_tracking.pending_requests or [])}
+        if poller:
+            state.update(poller.state())
+        jobs.progress(state)